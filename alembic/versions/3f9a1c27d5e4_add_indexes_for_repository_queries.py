@@ -0,0 +1,28 @@
+"""add indexes for repository queries
+
+Revision ID: 3f9a1c27d5e4
+Revises: 8c03478bb01d
+Create Date: 2026-10-17 17:48:31.771092
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a1c27d5e4'
+down_revision: Union[str, None] = '8c03478bb01d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_messages_chat_id_created_at_id', 'messages', ['chat_id', 'created_at', 'id'])
+    op.create_index('ix_chat_members_user_id', 'chat_members', ['user_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_members_user_id', table_name='chat_members')
+    op.drop_index('ix_messages_chat_id_created_at_id', table_name='messages')
@@ -0,0 +1,51 @@
+"""add member key to chats
+
+Revision ID: 5e2d8a61f0b7
+Revises: b71e4d0c9a32
+Create Date: 2026-10-17 18:12:40.105377
+
+"""
+import hashlib
+from collections import defaultdict
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2d8a61f0b7'
+down_revision: Union[str, None] = 'b71e4d0c9a32'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('member_key', sa.String(length=64), nullable=True))
+
+    # existing duplicates keep their history, only the most recently active chat of a pair gets the key
+    connection = op.get_bind()
+    members = defaultdict(list)
+    for chat_id, user_id in connection.execute(sa.text("""
+        SELECT chat_id, user_id FROM chat_members
+        WHERE chat_id IN (SELECT chat_id FROM chat_members GROUP BY chat_id HAVING COUNT(*) = 2)
+    """)):
+        members[chat_id].append(user_id)
+    last_message_at = dict(connection.execute(sa.text('SELECT id, last_message_at FROM chats')).all())
+
+    keys = {}
+    for chat_id, user_ids in sorted(members.items(), key=lambda item: (last_message_at[item[0]], item[0])):
+        keys[hashlib.sha256('\x1f'.join(sorted(user_ids)).encode()).hexdigest()] = chat_id
+    if keys:
+        connection.execute(
+            sa.text('UPDATE chats SET member_key = :member_key WHERE id = :chat_id'),
+            [{'member_key': member_key, 'chat_id': chat_id} for member_key, chat_id in keys.items()],
+        )
+
+    op.create_index('ix_chats_member_key', 'chats', ['member_key'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chats_member_key', table_name='chats')
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.drop_column('member_key')
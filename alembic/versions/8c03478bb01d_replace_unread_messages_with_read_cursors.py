@@ -0,0 +1,59 @@
+"""replace unread_messages with chat_members.last_read_message_id
+
+Revision ID: 8c03478bb01d
+Revises: 15824d844d30
+Create Date: 2026-10-17 17:40:12.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c03478bb01d'
+down_revision: Union[str, None] = '15824d844d30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'chat_members',
+        sa.Column('last_read_message_id', sa.Integer(), server_default='0', nullable=False),
+    )
+    # unread rows of a member are always the tail of a chat, everything before
+    # the oldest unread message is read
+    op.execute("""
+        UPDATE chat_members SET last_read_message_id = COALESCE(
+            (
+                SELECT MIN(unread_messages.message_id) - 1 FROM unread_messages
+                WHERE unread_messages.chat_id = chat_members.chat_id
+                AND unread_messages.user_id = chat_members.user_id
+            ),
+            (SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chat_members.chat_id),
+            0
+        )
+    """)
+    op.drop_table('unread_messages')
+
+
+def downgrade() -> None:
+    op.create_table('unread_messages',
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.String(length=150), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ),
+    sa.PrimaryKeyConstraint('message_id', 'user_id', name='unread_messages_pk')
+    )
+    op.execute("""
+        INSERT INTO unread_messages (chat_id, message_id, user_id)
+        SELECT messages.chat_id, messages.id, chat_members.user_id
+        FROM messages JOIN chat_members ON chat_members.chat_id = messages.chat_id
+        WHERE messages.id > chat_members.last_read_message_id
+        AND messages.sender_id != chat_members.user_id
+    """)
+    with op.batch_alter_table('chat_members') as batch_op:
+        batch_op.drop_column('last_read_message_id')
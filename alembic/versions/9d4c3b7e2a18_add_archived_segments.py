@@ -0,0 +1,44 @@
+"""add archived segments
+
+Revision ID: 9d4c3b7e2a18
+Revises: 5e2d8a61f0b7
+Create Date: 2026-10-17 18:40:12.527904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4c3b7e2a18'
+down_revision: Union[str, None] = '5e2d8a61f0b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'archived_segments',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('path', sa.String(length=255), nullable=False),
+        sa.Column('first_id', sa.Integer(), nullable=False),
+        sa.Column('last_id', sa.Integer(), nullable=False),
+        sa.Column('first_created_at', sa.Float(), nullable=False),
+        sa.Column('last_created_at', sa.Float(), nullable=False),
+        sa.Column('message_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'ix_archived_segments_chat_id_first_id', 'archived_segments', ['chat_id', 'first_id'], unique=True,
+    )
+    op.create_index('ix_messages_created_at', 'messages', ['created_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_created_at', table_name='messages')
+    op.drop_index('ix_archived_segments_chat_id_first_id', table_name='archived_segments')
+    op.drop_table('archived_segments')
@@ -0,0 +1,38 @@
+"""add last message to chats
+
+Revision ID: b71e4d0c9a32
+Revises: 3f9a1c27d5e4
+Create Date: 2026-10-17 17:56:02.318442
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b71e4d0c9a32'
+down_revision: Union[str, None] = '3f9a1c27d5e4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_at', sa.Float(), server_default='0', nullable=False))
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'])
+    op.execute("""
+        UPDATE chats SET last_message_id = (SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id)
+    """)
+    op.execute("""
+        UPDATE chats SET last_message_at = (SELECT messages.created_at FROM messages WHERE messages.id = chats.last_message_id)
+        WHERE last_message_id IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.drop_column('last_message_at')
+        batch_op.drop_column('last_message_id')
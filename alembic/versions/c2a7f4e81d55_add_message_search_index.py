@@ -0,0 +1,63 @@
+"""add message search index
+
+Revision ID: c2a7f4e81d55
+Revises: 9d4c3b7e2a18
+Create Date: 2026-10-17 19:05:47.310256
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2a7f4e81d55'
+down_revision: Union[str, None] = '9d4c3b7e2a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        # external content fts5 table kept in sync with messages by triggers, chat ids are
+        # indexed too so a search is limited to the user's chats inside the fts index
+        op.execute(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5(text, chat_id, content='messages', content_rowid='id')"
+        )
+        op.execute("""
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, text, chat_id) VALUES (new.id, new.text, new.chat_id);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, chat_id)
+                VALUES ('delete', old.id, old.text, old.chat_id);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, chat_id)
+                VALUES ('delete', old.id, old.text, old.chat_id);
+                INSERT INTO messages_fts(rowid, text, chat_id) VALUES (new.id, new.text, new.chat_id);
+            END
+        """)
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    else:
+        op.create_index(
+            'ix_messages_text_search',
+            'messages',
+            [sa.text("to_tsvector('simple', text)")],
+            postgresql_using='gin',
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TRIGGER messages_fts_update')
+        op.execute('DROP TRIGGER messages_fts_delete')
+        op.execute('DROP TRIGGER messages_fts_insert')
+        op.execute('DROP TABLE messages_fts')
+    else:
+        op.drop_index('ix_messages_text_search', table_name='messages')
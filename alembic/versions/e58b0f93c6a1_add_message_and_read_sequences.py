@@ -0,0 +1,52 @@
+"""add message and read sequences
+
+Revision ID: e58b0f93c6a1
+Revises: c2a7f4e81d55
+Create Date: 2026-10-17 19:32:05.884120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e58b0f93c6a1'
+down_revision: Union[str, None] = 'c2a7f4e81d55'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('message_seq', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('chat_members', sa.Column('read_seq', sa.Integer(), server_default='0', nullable=False))
+    op.execute("""
+        UPDATE chats SET message_seq = (
+            SELECT COUNT(*) FROM messages WHERE messages.chat_id = chats.id
+        ) + (
+            SELECT COALESCE(SUM(message_count), 0) FROM archived_segments WHERE archived_segments.chat_id = chats.id
+        )
+    """)
+    # unread messages of others, archived segments after the cursor count as unread as a whole
+    op.execute("""
+        UPDATE chat_members SET read_seq = (
+            SELECT message_seq FROM chats WHERE chats.id = chat_members.chat_id
+        ) - (
+            SELECT COUNT(*) FROM messages
+            WHERE messages.chat_id = chat_members.chat_id
+                AND messages.id > chat_members.last_read_message_id
+                AND messages.sender_id != chat_members.user_id
+        ) - (
+            SELECT COALESCE(SUM(message_count), 0) FROM archived_segments
+            WHERE archived_segments.chat_id = chat_members.chat_id
+                AND archived_segments.first_id > chat_members.last_read_message_id
+        )
+    """)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('chat_members') as batch_op:
+        batch_op.drop_column('read_seq')
+    with op.batch_alter_table('chats') as batch_op:
+        batch_op.drop_column('message_seq')
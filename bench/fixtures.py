@@ -0,0 +1,39 @@
+import random
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from mess_message.models import Base
+from mess_message.models.chat import Chat, ChatMember, Message
+
+
+def user_id(chat_id: int, member: int) -> str:
+    return f'user-{chat_id}-{member}'
+
+
+async def create_database(engine: AsyncEngine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def seed_database(engine: AsyncEngine, chats: int, members: int, messages: int = 0):
+    """Every chat gets `members` members and `messages` messages from random members."""
+    async with engine.begin() as conn:
+        await conn.execute(insert(Chat), [{'id': chat_id, 'name': f'chat {chat_id}'} for chat_id in range(1, chats + 1)])
+        await conn.execute(insert(ChatMember), [
+            {'chat_id': chat_id, 'user_id': user_id(chat_id, member)}
+            for chat_id in range(1, chats + 1)
+            for member in range(members)
+        ])
+        if messages:
+            await conn.execute(insert(Message), [
+                {
+                    'chat_id': chat_id,
+                    'sender_id': user_id(chat_id, random.randrange(members)),
+                    'text': f'message {n}',
+                    'created_at': float(n * chats + chat_id),
+                }
+                for n in range(messages)
+                for chat_id in range(1, chats + 1)
+            ])
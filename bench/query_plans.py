@@ -0,0 +1,132 @@
+"""Fails if a hot Repository query falls back to a full table scan.
+
+    python bench/query_plans.py [--db-url postgresql+asyncpg://...]
+
+Runs every hot Repository method against a seeded database, records the
+statements it issues and checks their plans with EXPLAIN. SQLite by default,
+on Postgres sequential scans are disabled so the plan shows whether an index
+can be used at all. Exits with 1 when a full scan is found.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('ENVIRONMENT', 'bench')
+os.environ.setdefault('ASYNC_DB_URL', 'sqlite+aiosqlite://')
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine  # noqa: E402
+
+from fixtures import create_database, seed_database, user_id  # noqa: E402
+from mess_message.cache import MembershipCache  # noqa: E402
+from mess_message.repository import Repository  # noqa: E402
+
+TABLES = ('chats', 'chat_members', 'messages')
+
+
+def hot_queries(repository: Repository) -> dict:
+    return {
+        'get_chat_member_ids': lambda: repository.get_chat_member_ids(7),
+        'get_chat': lambda: repository.get_chat(7),
+        'get_chat_by_member_key': lambda: repository.get_chat_by_member_key('0' * 64),
+        'get_last_read_message_ids': lambda: repository.get_last_read_message_ids([7, 8], user_id(7, 1)),
+        'get_unread_counts': lambda: repository.get_unread_counts(user_id(7, 1)),
+        'get_chat_messages': lambda: repository.get_chat_messages(7, 50),
+        'get_chat_messages_before': lambda: repository.get_chat_messages(7, 50, before=(5000.0, 5000)),
+        'get_chat_messages_after': lambda: repository.get_chat_messages(7, 50, after=(5000.0, 5000)),
+        'get_chats_by_user_id': lambda: repository.get_chats_by_user_id(20, user_id(7, 1)),
+        'get_chats_by_user_id_before': lambda: repository.get_chats_by_user_id(20, user_id(7, 1), before=(500.0, 7)),
+        'get_chats_member_ids': lambda: repository.get_chats_member_ids([7, 8]),
+        'stream_chat_messages': lambda: _drain(repository.stream_chat_messages(7, 50, before=(5000.0, 5000))),
+        'get_user_messages_after': lambda: repository.get_user_messages_after(user_id(7, 1), 5000, 9000, 200),
+        'get_last_message_id': lambda: repository.get_last_message_id(),
+        'get_archivable_messages': lambda: repository.get_archivable_messages(50.0, 1000),
+        'save_message': lambda: repository.save_message(7, user_id(7, 1), 'bench'),
+        'read_messages': lambda: repository.read_messages([(7, user_id(7, 2), 5000)]),
+        'read_all_messages': lambda: repository.read_all_messages(7, user_id(7, 1)),
+    }
+
+
+async def _drain(result):
+    return [row async for row in await result]
+
+
+def sqlite_full_scans(plan: list) -> list[str]:
+    # rows are (id, parent, notused, detail), "SCAN <table>" without an index is a full scan
+    return [
+        row[-1] for row in plan
+        if row[-1].startswith('SCAN ') and row[-1].split()[1] in TABLES and 'INDEX' not in row[-1]
+    ]
+
+
+def postgres_full_scans(plan) -> list[str]:
+    scans = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in TABLES:
+            scans.append(f'Seq Scan on {node["Relation Name"]}')
+        nodes.extend(node.get('Plans', []))
+    return scans
+
+
+async def check(engine) -> dict:
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            statements.append((statement, parameters))
+
+    session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    report = {}
+    async with session_factory() as session:
+        # a fresh cache so every query reaches the database
+        repository = Repository(session, members_cache=MembershipCache(max_size=0, ttl=0))
+        for name, query in hot_queries(repository).items():
+            statements.clear()
+            event.listen(engine.sync_engine, 'before_cursor_execute', record)
+            try:
+                await query()
+            finally:
+                event.remove(engine.sync_engine, 'before_cursor_execute', record)
+
+            report[name] = []
+            for statement, parameters in statements:
+                async with engine.connect() as conn:
+                    if engine.dialect.name == 'sqlite':
+                        plan = (await conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)).all()
+                        report[name].extend(sqlite_full_scans(plan))
+                    else:
+                        await conn.exec_driver_sql('SET enable_seqscan = off')
+                        plan = (await conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)).scalar()
+                        report[name].extend(postgres_full_scans(plan))
+
+    return report
+
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(args.db_url or f'sqlite+aiosqlite:///{tmp}/plans.sqlite3')
+        await create_database(engine)
+        await seed_database(engine, args.chats, args.members, args.messages)
+        try:
+            return await check(engine)
+        finally:
+            await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url', help='database to run against, its tables are dropped and recreated. '
+                        'A temporary sqlite file by default')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=100)
+
+    report = asyncio.run(run(parser.parse_args()))
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if any(report.values()) else 0)
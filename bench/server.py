@@ -0,0 +1,42 @@
+"""Runs mess_message.main:app for bench/load.py with a stats endpoint.
+
+GET /bench/stats returns the number of SQL statements executed so far and
+the peak RSS of the process.
+"""
+import argparse
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import uvicorn  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from mess_message import db  # noqa: E402
+from mess_message.main import app, conn_manager  # noqa: E402
+
+queries = 0
+
+
+@event.listens_for(db.engine.sync_engine, 'before_cursor_execute')
+def count_query(*_):
+    global queries
+    queries += 1
+
+
+@app.get('/bench/stats')
+async def stats():
+    return {
+        'queries': queries,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **conn_manager.queue_stats(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
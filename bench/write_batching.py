@@ -0,0 +1,90 @@
+"""Throughput vs latency of MessageWriter group commit against Repository.save_message.
+
+    python bench/write_batching.py --senders 200 --messages 20
+
+Every sender is a coroutine that saves its messages one after another, like a
+websocket loop does. Results are printed as json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('ENVIRONMENT', 'bench')
+os.environ.setdefault('ASYNC_DB_URL', 'sqlite+aiosqlite://')
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine  # noqa: E402
+
+from fixtures import create_database, seed_database, user_id  # noqa: E402
+from mess_message.repository import Repository  # noqa: E402
+from mess_message.writer import MessageWriter  # noqa: E402
+
+
+async def drive(save, senders: int, messages: int, chats: int) -> dict:
+    latencies = []
+
+    async def sender(n: int):
+        chat_id = n % chats + 1
+        for i in range(messages):
+            started = time.perf_counter()
+            await save(chat_id, user_id(chat_id, 0), f'message {i} from {n}')
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[sender(n) for n in range(senders)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'messages_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+
+
+async def run(args) -> list[dict]:
+    results = []
+    for mode in ['repository'] + [f'writer:{batch}:{linger}' for batch in args.batch_sizes for linger in args.lingers_ms]:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_async_engine(args.db_url or f'sqlite+aiosqlite:///{tmp}/bench.sqlite3')
+            session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+            await create_database(engine)
+            await seed_database(engine, args.chats, args.members)
+
+            if mode == 'repository':
+                async def save(chat_id, sender_id, text):
+                    async with session_factory() as session:
+                        await Repository(session).save_message(chat_id, sender_id, text)
+
+                result = await drive(save, args.senders, args.messages, args.chats)
+                results.append({'mode': mode, **result})
+            else:
+                _, batch, linger = mode.split(':')
+                writer = MessageWriter(session_factory, max_batch_size=int(batch), max_linger=float(linger) / 1000)
+                await writer.start()
+                result = await drive(writer.save_message, args.senders, args.messages, args.chats)
+                await writer.stop()
+                results.append({'mode': 'writer', 'max_batch_size': int(batch), 'max_linger_ms': float(linger), **result})
+
+            await engine.dispose()
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-url', help='database to run against, its tables are dropped and recreated. '
+                        'A temporary sqlite file by default')
+    parser.add_argument('--senders', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--lingers-ms', type=float, nargs='+', default=[1, 5])
+
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
@@ -0,0 +1,62 @@
+import asyncio
+import gzip
+import json
+import os
+import uuid
+from typing import Optional
+
+from mess_message import settings
+
+# message columns kept in segment files, one json object per line
+FIELDS = ('id', 'chat_id', 'sender_id', 'text', 'created_at')
+
+
+class SegmentStore:
+    """Cold storage of archived messages as gzipped jsonl files.
+
+    A segment holds consecutive archived messages of one chat, paths are
+    relative to the store directory and are recorded in archived_segments.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    async def write(self, chat_id: int, rows: list[dict]) -> str:
+        # unique, workers racing for the same batch don't overwrite each other's files
+        name = f'{rows[0]["id"]}-{rows[-1]["id"]}-{uuid.uuid4().hex[:8]}.jsonl.gz'
+        path = os.path.join(str(chat_id), name)
+        await asyncio.to_thread(self._write, path, rows)
+        return path
+
+    async def read(self, path: str) -> list[dict]:
+        return await asyncio.to_thread(self._read, path)
+
+    async def remove(self, path: str):
+        await asyncio.to_thread(self._remove, path)
+
+    def _write(self, path: str, rows: list[dict]):
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # readers never see a partial segment
+        tmp_path = full_path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps({field: row[field] for field in FIELDS}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, full_path)
+
+    def _read(self, path: str) -> list[dict]:
+        with gzip.open(os.path.join(self.directory, path), 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def _remove(self, path: str):
+        try:
+            os.remove(os.path.join(self.directory, path))
+        except FileNotFoundError:
+            pass
+
+
+segment_store: Optional[SegmentStore] = (
+    SegmentStore(settings.get_settings().archive_dir) if settings.get_settings().archive_enabled else None
+)
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from mess_message import logger
+from mess_message.archive import SegmentStore
+from mess_message.repository import Repository
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+
+class Archiver:
+    """Moves messages older than the retention from the messages table to segment files.
+
+    Every `interval` seconds batches of the oldest messages are written to the
+    store, one segment per chat, and deleted from the table in the same
+    transaction that records the segments. The last message of a chat is never
+    archived, the inbox reads it from the table.
+    """
+
+    def __init__(
+            self,
+            session_factory: async_sessionmaker[AsyncSession],
+            store: SegmentStore,
+            retention: float,
+            batch_size: int = 1000,
+            interval: float = 60.0,
+    ):
+        self.session_factory = session_factory
+        self.store = store
+        self.retention = retention
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.archive_batch() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger_.exception(f'archiving failed: {e}')
+            await asyncio.sleep(self.interval)
+
+    async def archive_batch(self) -> int:
+        async with self.session_factory() as session:
+            repository = Repository(session)
+            rows = await repository.get_archivable_messages(time.time() - self.retention, self.batch_size)
+            if not rows:
+                return 0
+
+            rows_by_chat = defaultdict(list)
+            for row in rows:
+                rows_by_chat[row['chat_id']].append(row)
+            segments = [
+                (chat_id, await self.store.write(chat_id, chat_rows), chat_rows)
+                for chat_id, chat_rows in rows_by_chat.items()
+            ]
+
+            if not await repository.save_archived_segments(segments):
+                # another worker archived some of the messages first
+                for _, path, _ in segments:
+                    await self.store.remove(path)
+                return 0
+
+        logger_.info(f'archived {len(rows)} messages of {len(segments)} chats')
+        return len(rows)
@@ -0,0 +1,117 @@
+"""Standalone pub/sub broker for running several workers.
+
+    python -m mess_message.broker [socket path]
+
+Every worker connects with `bus.BrokerBus` and reports which users have
+sockets on it, published messages are forwarded only to those workers.
+It also keeps rate limit token buckets shared by the workers.
+Frames are newline delimited json.
+"""
+import asyncio
+import json
+import os
+import sys
+
+from mess_message import logger, settings
+from mess_message.bus import MAX_FRAME_SIZE, read_frame
+from mess_message.ratelimit import RateLimiter
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+
+class Broker:
+    def __init__(self):
+        self.workers: dict[str, asyncio.StreamWriter] = {}
+        self.presence: dict[str, set[str]] = {}
+        # (rate, burst) -> token buckets shared by all workers
+        self.limiters: dict[tuple[float, int], RateLimiter] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            while line := await read_frame(reader):
+                frame = json.loads(line)
+                op = frame['op']
+
+                if op == 'hello':
+                    worker_id = frame['worker']
+                    self.workers[worker_id] = writer
+                    logger_.info(f'worker connected: {worker_id}')
+                elif op == 'online':
+                    self.presence.setdefault(frame['user'], set()).add(worker_id)
+                elif op == 'offline':
+                    self._remove_presence(frame['user'], worker_id)
+                elif op == 'publish':
+                    self._publish(worker_id, frame)
+                elif op == 'invalidate':
+                    self._broadcast(worker_id, frame)
+                elif op == 'take':
+                    writer.write(json.dumps({
+                        'op': 'taken',
+                        'id': frame['id'],
+                        'allowed': self._take(frame['key'], frame['rate'], frame['burst']),
+                    }).encode() + b'\n')
+                else:
+                    logger_.error(f'unknown op from {worker_id}: {op}')
+        except Exception as e:
+            logger_.exception(f'worker {worker_id} error: {e}')
+        finally:
+            logger_.info(f'worker disconnected: {worker_id}')
+            if worker_id is not None:
+                self.workers.pop(worker_id, None)
+                for user_id in [user_id for user_id, workers in self.presence.items() if worker_id in workers]:
+                    self._remove_presence(user_id, worker_id)
+            writer.close()
+
+    def _publish(self, origin: str, frame: dict):
+        recipients: dict[str, list[str]] = {}
+        for user_id in frame['users']:
+            for worker_id in self.presence.get(user_id, ()):
+                if worker_id != origin:
+                    recipients.setdefault(worker_id, []).append(user_id)
+
+        for worker_id, user_ids in recipients.items():
+            self.workers[worker_id].write(json.dumps({
+                'op': 'deliver',
+                'users': user_ids,
+                'data': frame['data'],
+                'binary': frame.get('binary', False),
+            }).encode() + b'\n')
+
+    def _broadcast(self, origin: str, frame: dict):
+        data = json.dumps(frame).encode() + b'\n'
+        for worker_id, writer in self.workers.items():
+            if worker_id != origin:
+                writer.write(data)
+
+    def _take(self, key: str, rate: float, burst: int) -> bool:
+        limiter = self.limiters.get((rate, burst))
+        if limiter is None:
+            limiter = self.limiters[(rate, burst)] = RateLimiter(
+                rate, burst, settings.get_settings().rate_limit_max_keys,
+            )
+        return limiter.take_nowait(key)
+
+    def _remove_presence(self, user_id: str, worker_id: str):
+        workers = self.presence.get(user_id)
+        if workers is None:
+            return
+
+        workers.discard(worker_id)
+        if not workers:
+            del self.presence[user_id]
+
+
+async def serve(path: str):
+    if os.path.exists(path):
+        os.unlink(path)
+
+    broker = Broker()
+    server = await asyncio.start_unix_server(broker.handle, path, limit=MAX_FRAME_SIZE)
+    logger_.info(f'broker listening on {path}')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(sys.argv[1] if len(sys.argv) > 1 else settings.get_settings().broker_socket_path))
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import socket
+from typing import Callable, Optional, Sequence
+
+from mess_message import logger
+from mess_message.encoding import Frame
+from mess_message.settings import Settings
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+OnMessage = Callable[[Sequence[str], Frame], None]
+OnInvalidate = Callable[[int], None]
+
+# longest frame read from the broker socket, longer ones are dropped
+MAX_FRAME_SIZE = 1024 * 1024
+# recipients per publish frame, keeps frames of large groups under the limit
+PUBLISH_CHUNK_SIZE = 1000
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    """Reads the next line, b'' at the end of the stream. Lines over the reader's
+    limit are skipped, the connection stays usable."""
+    skipping = False
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return b'' if skipping else e.partial
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+            skipping = True
+            continue
+
+        if not skipping:
+            return line
+        logger_.error('dropped a broker frame over the size limit')
+        skipping = False
+
+
+class Bus:
+    """Routes messages to recipients connected to other workers.
+
+    ConnectionManager always delivers to its own sockets first, a bus is only
+    responsible for the rest of the cluster.
+    """
+
+    async def start(self, on_message: OnMessage):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def register(self, user_id: str):
+        pass
+
+    async def unregister(self, user_id: str):
+        pass
+
+    async def publish(self, user_ids: Sequence[str], message: Frame):
+        pass
+
+    def invalidate_membership(self, chat_id: int):
+        pass
+
+    def subscribe_invalidations(self, callback: OnInvalidate):
+        pass
+
+
+class LocalBus(Bus):
+    """Single process deployment, there is nobody else to deliver to."""
+
+
+class BrokerBus(Bus):
+    """Talks to `mess_message.broker` over a unix socket.
+
+    The broker keeps a presence registry of user_id -> workers and forwards
+    published messages only to the workers that hold the recipient's sockets.
+    """
+
+    def __init__(self, path: str, worker_id: Optional[str] = None, reconnect_delay: float = 1.0):
+        self.path = path
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.reconnect_delay = reconnect_delay
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._task: Optional[asyncio.Task] = None
+        self._on_message: Optional[OnMessage] = None
+        self._on_invalidate: Optional[OnInvalidate] = None
+        # kept to restore presence after the broker restarts
+        self._online: set[str] = set()
+        # request id -> future of a broker reply
+        self._requests: dict[int, asyncio.Future] = {}
+        self._request_id = 0
+
+    async def start(self, on_message: OnMessage):
+        self._on_message = on_message
+        await self._connect()
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def register(self, user_id: str):
+        self._online.add(user_id)
+        self._send({'op': 'online', 'user': user_id})
+
+    async def unregister(self, user_id: str):
+        self._online.discard(user_id)
+        self._send({'op': 'offline', 'user': user_id})
+
+    async def publish(self, user_ids: Sequence[str], message: Frame):
+        if not user_ids:
+            return
+
+        for start in range(0, len(user_ids), PUBLISH_CHUNK_SIZE):
+            chunk = user_ids[start:start + PUBLISH_CHUNK_SIZE]
+            if isinstance(message, bytes):
+                self._send({'op': 'publish', 'users': chunk, 'data': message.decode(), 'binary': True})
+            else:
+                self._send({'op': 'publish', 'users': chunk, 'data': message})
+
+    def invalidate_membership(self, chat_id: int):
+        self._send({'op': 'invalidate', 'chat': chat_id})
+
+    def subscribe_invalidations(self, callback: OnInvalidate):
+        self._on_invalidate = callback
+
+    async def take(self, key: str, rate: float, burst: int, timeout: float = 0.5) -> bool:
+        """Takes a token from a bucket kept by the broker. Allows when the broker
+        doesn't answer, a broker outage must not stop the chat."""
+        if self._writer is None or self._writer.is_closing():
+            return True
+
+        self._request_id += 1
+        request_id = self._request_id
+        future = self._requests[request_id] = asyncio.get_running_loop().create_future()
+        self._send({'op': 'take', 'id': request_id, 'key': key, 'rate': rate, 'burst': burst})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger_.warning(f'broker did not answer a rate limit request for {key}')
+            return True
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MAX_FRAME_SIZE)
+        self._send({'op': 'hello', 'worker': self.worker_id})
+        for user_id in self._online:
+            self._send({'op': 'online', 'user': user_id})
+
+    def _send(self, frame: dict):
+        if self._writer is None or self._writer.is_closing():
+            logger_.warning(f'broker is not connected, dropping {frame["op"]} frame')
+            return
+        self._writer.write(json.dumps(frame).encode() + b'\n')
+
+    async def _listen(self):
+        while True:
+            try:
+                line = await read_frame(self._reader)
+                if not line:
+                    raise ConnectionError('broker closed the connection')
+
+                frame = json.loads(line)
+                if frame['op'] == 'deliver':
+                    data = frame['data'].encode() if frame.get('binary') else frame['data']
+                    self._on_message(frame['users'], data)
+                elif frame['op'] == 'invalidate' and self._on_invalidate is not None:
+                    self._on_invalidate(frame['chat'])
+                elif frame['op'] == 'taken':
+                    future = self._requests.get(frame['id'])
+                    if future is not None and not future.done():
+                        future.set_result(frame['allowed'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger_.error(f'broker connection error: {e}')
+                await self._reconnect()
+
+    async def _reconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+                logger_.info('reconnected to broker')
+                return
+            except OSError as e:
+                logger_.error(f'cannot reconnect to broker: {e}')
+
+
+def get_bus(settings: Settings) -> Bus:
+    if settings.delivery_backend == 'local':
+        return LocalBus()
+    if settings.delivery_backend == 'broker':
+        return BrokerBus(settings.broker_socket_path)
+    raise ValueError(f'unknown delivery backend: {settings.delivery_backend}')
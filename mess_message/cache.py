@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+from mess_message import settings
+
+
+class MembershipCache:
+    """chat_id -> member user ids with LRU and TTL eviction.
+
+    Writers must call `invalidate` after changing members of a chat, listeners
+    are used to propagate invalidations to other workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[float, frozenset[str]]] = OrderedDict()
+        self._listeners: list[Callable[[int], None]] = []
+
+    def get(self, chat_id: int) -> Optional[frozenset[str]]:
+        item = self._items.get(chat_id)
+        if item is None:
+            return None
+
+        expires_at, member_ids = item
+        if expires_at < time.monotonic():
+            del self._items[chat_id]
+            return None
+
+        self._items.move_to_end(chat_id)
+        return member_ids
+
+    def set(self, chat_id: int, member_ids: Iterable[str]):
+        self._items[chat_id] = (time.monotonic() + self.ttl, frozenset(member_ids))
+        self._items.move_to_end(chat_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, chat_id: int, propagate: bool = True):
+        self._items.pop(chat_id, None)
+        if propagate:
+            for listener in self._listeners:
+                listener(chat_id)
+
+    def add_invalidation_listener(self, listener: Callable[[int], None]):
+        self._listeners.append(listener)
+
+
+class RecentMessages:
+    """(user_id, client_message_id) -> future of the saved message, LRU bounded.
+
+    A message retried by a client, e.g. after a reconnect, is answered from here
+    instead of being saved again. Retries that reach another worker are not seen.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[tuple[str, str], asyncio.Future] = OrderedDict()
+
+    def get(self, user_id: str, client_message_id: str) -> Optional[asyncio.Future]:
+        future = self._items.get((user_id, client_message_id))
+        if future is not None:
+            self._items.move_to_end((user_id, client_message_id))
+        return future
+
+    def add(self, user_id: str, client_message_id: str) -> asyncio.Future:
+        future = self._items[(user_id, client_message_id)] = asyncio.get_running_loop().create_future()
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return future
+
+    def discard(self, user_id: str, client_message_id: str):
+        self._items.pop((user_id, client_message_id), None)
+
+
+class RecentTyping:
+    """(chat_id, user_id) -> when a typing event was last sent, LRU bounded.
+
+    Clients send typing frames on every keystroke, members only need one per interval.
+    """
+
+    def __init__(self, max_size: int, interval: float):
+        self.max_size = max_size
+        self.interval = interval
+        self._items: OrderedDict[tuple[int, str], float] = OrderedDict()
+
+    def take(self, chat_id: int, user_id: str) -> bool:
+        """False when the user's typing event was sent to the chat within the interval."""
+        now = time.monotonic()
+        sent_at = self._items.get((chat_id, user_id))
+        if sent_at is not None and now - sent_at < self.interval:
+            return False
+
+        self._items[(chat_id, user_id)] = now
+        self._items.move_to_end((chat_id, user_id))
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return True
+
+
+membership_cache = MembershipCache(
+    max_size=settings.get_settings().membership_cache_size,
+    ttl=settings.get_settings().membership_cache_ttl,
+)
+recent_messages = RecentMessages(settings.get_settings().recent_messages_size)
+recent_typing = RecentTyping(
+    max_size=settings.get_settings().recent_typing_size,
+    interval=settings.get_settings().typing_event_interval,
+)
@@ -1,8 +1,41 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker, AsyncEngine
 
 from mess_message import settings
 
-engine = create_async_engine(settings.get_settings().async_db_url)
+
+def create_engine(settings_: settings.Settings) -> AsyncEngine:
+    url = make_url(settings_.async_db_url)
+
+    if url.get_backend_name() == 'sqlite':
+        engine = create_async_engine(url)
+
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in settings_.sqlite_pragmas.items():
+                cursor.execute(f'PRAGMA {pragma}={value}')
+            cursor.close()
+
+        return engine
+
+    connect_args = {}
+    if url.get_driver_name() == 'asyncpg':
+        connect_args['prepared_statement_cache_size'] = settings_.db_prepared_statement_cache_size
+
+    return create_async_engine(
+        url,
+        pool_size=settings_.db_pool_size,
+        max_overflow=settings_.db_max_overflow,
+        pool_timeout=settings_.db_pool_timeout,
+        pool_recycle=settings_.db_pool_recycle,
+        pool_pre_ping=settings_.db_pool_pre_ping,
+        connect_args=connect_args,
+    )
+
+
+engine = create_engine(settings.get_settings())
 async_session = async_sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
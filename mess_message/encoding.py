@@ -0,0 +1,37 @@
+import json
+from typing import Any, Union
+
+from pydantic import BaseModel
+
+from mess_message import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Frame = Union[str, bytes]
+
+
+def encode(model: BaseModel) -> Frame:
+    """Encodes a model into a ready to send websocket frame.
+
+    Called once per fan-out, the same frame is then pushed to every socket.
+    Binary frames are returned as bytes, text frames as str.
+    """
+    settings_ = settings.get_settings()
+
+    if settings_.json_encoder == 'orjson' and orjson is not None:
+        data = orjson.dumps(model.model_dump())
+        return data if settings_.ws_binary_frames else data.decode()
+
+    data = model.model_dump_json()
+    return data.encode() if settings_.ws_binary_frames else data
+
+
+def dumps(obj: Any) -> str:
+    """Plain json values, used where building pydantic models is not worth it."""
+    if settings.get_settings().json_encoder == 'orjson' and orjson is not None:
+        return orjson.dumps(obj).decode()
+
+    return json.dumps(obj, separators=(',', ':'))
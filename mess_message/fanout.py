@@ -0,0 +1,67 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Collection, Optional
+
+from mess_message import logger
+from mess_message.encoding import Frame
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+# the recipients, the frame and a connection left out
+Deliver = Callable[[list[str], Frame, Any], None]
+Publish = Callable[[list[str], Frame], Awaitable[None]]
+
+
+class FanoutPool:
+    """Delivers broadcasts to large groups off the sender's coroutine.
+
+    `submit` only queues the broadcast. A dispatcher splits the recipients into
+    shards by user id and every shard has its own task and queue, so frames to
+    a user keep their order. Shards deliver `chunk_size` recipients at a time
+    and yield to the event loop in between.
+    """
+
+    def __init__(self, deliver: Deliver, publish: Publish, shards: int = 4, chunk_size: int = 500):
+        self.deliver = deliver
+        self.publish = publish
+        self.chunk_size = chunk_size
+        self._queue: asyncio.Queue[tuple[Collection[str], Frame, Optional[str], Any]] = asyncio.Queue()
+        self._shards: list[asyncio.Queue[tuple[list[str], Frame, Any]]] = [asyncio.Queue() for _ in range(shards)]
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._run_shard(queue)) for queue in self._shards]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def submit(self, recipients: Collection[str], message: Frame, skip: Optional[str] = None, exclude: Any = None):
+        self._queue.put_nowait((recipients, message, skip, exclude))
+
+    def queued(self) -> int:
+        return self._queue.qsize() + sum(queue.qsize() for queue in self._shards)
+
+    async def _dispatch(self):
+        while True:
+            recipients, message, skip, exclude = await self._queue.get()
+            chunks: list[list[str]] = [[] for _ in self._shards]
+            for user_id in recipients:
+                if user_id != skip:
+                    chunks[hash(user_id) % len(chunks)].append(user_id)
+
+            for queue, chunk in zip(self._shards, chunks):
+                if chunk:
+                    queue.put_nowait((chunk, message, exclude))
+
+    async def _run_shard(self, queue: asyncio.Queue[tuple[list[str], Frame, Any]]):
+        while True:
+            recipients, message, exclude = await queue.get()
+            for start in range(0, len(recipients), self.chunk_size):
+                chunk = recipients[start:start + self.chunk_size]
+                try:
+                    self.deliver(chunk, message, exclude)
+                    await self.publish(chunk, message)
+                except Exception as e:
+                    logger_.exception(f'fan-out to {len(chunk)} recipients failed: {e}')
+                await asyncio.sleep(0)
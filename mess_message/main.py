@@ -1,18 +1,119 @@
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, Depends, Header, HTTPException
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from mess_message import schemas, sender, logger
-from mess_message.managers import ConnectionManager
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+
+from mess_message import (
+    schemas, sender, logger, settings, bus, cache, db, metrics, encoding, streaming, archive, ratelimit,
+)
+from mess_message.archiver import Archiver
+from mess_message.managers import ConnectionManager, Connection
+from mess_message.receipts import ReadReceiptBatcher
+from mess_message.reconciler import UnreadReconciler
 from mess_message.repository import get_repository, Repository
-from mess_message.schemas import SearchChatResults, Chat
+from mess_message.schemas import SearchChatResults, SearchMessageResults, UnreadCounts, Chat
+from mess_message.writer import MessageWriter
 
 logger_ = logger.get_logger(__name__, stdout=True)
 
-app = FastAPI()
-conn_manager = ConnectionManager()
+conn_manager = ConnectionManager(
+    bus.get_bus(settings.get_settings()),
+    max_queue_size=settings.get_settings().ws_send_queue_size,
+    overflow_policy=settings.get_settings().ws_send_queue_overflow,
+    ping_interval=settings.get_settings().ws_ping_interval,
+    idle_timeout=settings.get_settings().ws_idle_timeout,
+    max_connections_per_key=settings.get_settings().ws_max_connections_per_user,
+    fanout_threshold=settings.get_settings().large_group_threshold,
+    fanout_shards=settings.get_settings().fanout_shards,
+    fanout_chunk_size=settings.get_settings().fanout_chunk_size,
+)
+message_writer = MessageWriter(
+    db.async_session,
+    max_batch_size=settings.get_settings().message_batch_max_size,
+    max_linger=settings.get_settings().message_batch_max_linger_ms / 1000,
+) if settings.get_settings().message_batching else None
+receipt_batcher = ReadReceiptBatcher(
+    db.async_session,
+    conn_manager,
+    window=settings.get_settings().read_receipt_window_ms / 1000,
+)
+archiver = Archiver(
+    db.async_session,
+    archive.segment_store,
+    retention=settings.get_settings().archive_retention_days * 24 * 60 * 60,
+    batch_size=settings.get_settings().archive_batch_size,
+    interval=settings.get_settings().archive_interval,
+) if archive.segment_store is not None else None
+unread_reconciler = UnreadReconciler(
+    db.async_session,
+    batch_size=settings.get_settings().unread_reconcile_batch_size,
+    interval=settings.get_settings().unread_reconcile_interval,
+) if settings.get_settings().unread_reconcile_enabled else None
+user_rate_limiter = ratelimit.get_rate_limiter(
+    settings.get_settings(),
+    conn_manager.bus,
+    'user',
+    settings.get_settings().user_rate_limit,
+    settings.get_settings().user_rate_limit_burst,
+) if settings.get_settings().rate_limit_enabled else None
+chat_rate_limiter = ratelimit.get_rate_limiter(
+    settings.get_settings(),
+    conn_manager.bus,
+    'chat',
+    settings.get_settings().chat_rate_limit,
+    settings.get_settings().chat_rate_limit_burst,
+) if settings.get_settings().rate_limit_enabled else None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    cache.membership_cache.add_invalidation_listener(conn_manager.bus.invalidate_membership)
+    conn_manager.bus.subscribe_invalidations(
+        lambda chat_id: cache.membership_cache.invalidate(chat_id, propagate=False)
+    )
+    await conn_manager.start()
+    if message_writer is not None:
+        await message_writer.start()
+    if archiver is not None:
+        await archiver.start()
+    if unread_reconciler is not None:
+        await unread_reconciler.start()
+    yield
+    if unread_reconciler is not None:
+        await unread_reconciler.stop()
+    if archiver is not None:
+        await archiver.stop()
+    await receipt_batcher.stop()
+    if message_writer is not None:
+        await message_writer.stop()
+    await conn_manager.stop()
+
+
+app = FastAPI(
+    lifespan=lifespan,
+    dependencies=[Depends(metrics.track_route)] if settings.get_settings().metrics_enabled else [],
+)
+
+if settings.get_settings().metrics_enabled:
+    metrics.instrument_engine(db.engine.sync_engine)
+    metrics.ws_connections.callback = lambda: conn_manager.queue_stats()['connections']
+    metrics.ws_send_queued.callback = lambda: conn_manager.queue_stats()['queued']
+    metrics.ws_send_dropped.callback = lambda: conn_manager.queue_stats()['dropped']
+    metrics.fanout_queued.callback = lambda: conn_manager.fanout.queued() if conn_manager.fanout is not None else 0
+
+    @app.get('/metrics')
+    async def get_metrics():
+        return Response(metrics.render(), media_type='text/plain; version=0.0.4')
 
 
 @app.middleware('http')
 async def validate_headers(request: Request, call_next):
+    if request.url.path == '/metrics':
+        return await call_next(request)
     if request.headers.get('x-user-id') is None:
         logger_.error('x-user-id header is missing')
         raise HTTPException(status_code=401)
@@ -23,56 +124,233 @@ async def validate_headers(request: Request, call_next):
 
 
 @app.websocket('/ws/message/v1/messages')
-async def message_socket(websocket: WebSocket, repository: Repository = Depends(get_repository)):
+async def message_socket(websocket: WebSocket):
     user_id = websocket.headers.get('x-user-id')
+    device_id = websocket.headers.get('x-device-id') or websocket.query_params.get('device_id')
+    last_seen_message_id = websocket.query_params.get('last_seen_message_id')
     # todo make conn_manager context manager, and maybe a dependency?
-    await conn_manager.connect(user_id, websocket)
+    # live messages wait behind the replay
+    connection = await conn_manager.connect(user_id, websocket, device_id, hold=last_seen_message_id is not None)
 
     try:
+        if last_seen_message_id is not None:
+            await replay_missed_messages(user_id, connection, last_seen_message_id)
+
         while True:
             data = await websocket.receive_text()
-            message = schemas.NewMessage.model_validate_json(data)
-
-            if user_id != message.sender_id:
-                logger_.error(f'user id in message does not match user id in headers: {user_id}, {message.sender_id}')
-                # todo this message will not be shown, it's not http
-                # todo logger
-                raise HTTPException(status_code=403)
-            if not await repository.is_user_in_chat(user_id, message.chat_id):
-                logger_.error(f'user {user_id} is not in chat {message.chat_id}')
-                # todo this message will not be shown, it's not http
-                # todo log that someone tried to send a message to a chat they are not in
-                raise HTTPException(status_code=403)
-
-            db_message = await repository.save_message(
-                chat_id=message.chat_id,
-                sender_id=user_id,
-                text=message.text,
-            )
-            message = schemas.Message(
-                chat_id=db_message.chat_id,
-                sender_id=db_message.sender_id,
-                text=db_message.text,
-                is_read=False,
-                created_at=db_message.created_at,
-            )
-            chat_members = await repository.get_chat_members(message.chat_id)
-            await sender.send_message(message, chat_members, conn_manager)
+            connection.last_seen = time.monotonic()
+            # checked before parsing, a flood of garbage costs the same as a flood of messages
+            if user_rate_limiter is not None and not await user_rate_limiter.take(user_id):
+                metrics.ws_throttled_frames.inc(('user',))
+                send_error(connection, 'rate_limited', 'too many frames')
+                continue
+
+            try:
+                frame = schemas.ClientFrame.validate_json(data)
+            except ValidationError as e:
+                send_error(connection, 'invalid_frame', str(e.errors(include_url=False)[0]['msg']))
+                continue
+
+            if isinstance(frame, schemas.NewMessage):
+                await handle_new_message(user_id, connection, frame)
+            elif isinstance(frame, schemas.ReadMessages):
+                await handle_read_messages(user_id, connection, frame)
+            elif isinstance(frame, schemas.DeliveredMessages):
+                await handle_delivered_messages(user_id, connection, frame)
+            elif isinstance(frame, schemas.Typing):
+                await handle_typing(user_id, connection, frame)
     except WebSocketDisconnect as e:
         logger_.info(f'websocket disconnected: {user_id}, code {e.code}: {e.reason}')
-        await conn_manager.disconnect(user_id, websocket)
     except Exception as e:
         logger_.exception(f'websocket error: {user_id}, {e}')
-        await websocket.close(code=1011)
+        await connection.close(code=1011)
         raise e
+    finally:
+        await conn_manager.disconnect(user_id, websocket)
+
+
+async def replay_missed_messages(user_id: str, connection: Connection, last_seen_message_id: str):
+    # messages saved after the connect are not replayed, they are among the frames held
+    # by the connection and sent after replay_done. One saved right before the connect
+    # may arrive twice, clients dedupe by id
+    try:
+        if not last_seen_message_id.isdecimal():
+            send_error(connection, 'invalid_frame', 'last_seen_message_id must be an integer')
+            return
+
+        settings_ = settings.get_settings()
+        after_id = int(last_seen_message_id)
+        up_to_id = None
+        sent = 0
+        truncated = False
+
+        while True:
+            limit = min(settings_.replay_chunk_size, settings_.replay_max_messages - sent)
+            if limit <= 0:
+                truncated = True
+                break
+
+            async with db.async_session() as session:
+                repository = Repository(session)
+                if up_to_id is None:
+                    up_to_id = await repository.get_last_message_id()
+                rows = await repository.get_user_messages_after(user_id, after_id, up_to_id, limit)
+
+            for message, last_read_message_id in rows:
+                # stops once the connection is closed, e.g. evicted or its writer failed
+                if not await connection.put(encoding.encode(schemas.Message(
+                    id=message.id,
+                    chat_id=message.chat_id,
+                    sender_id=message.sender_id,
+                    text=message.text,
+                    is_read=schemas.is_read(message.sender_id, message.id, user_id, last_read_message_id),
+                    created_at=message.created_at,
+                ))):
+                    return
+
+            sent += len(rows)
+            if rows:
+                after_id = rows[-1][0].id
+            if len(rows) < limit:
+                break
+
+        await connection.put(encoding.encode(schemas.ReplayDone(
+            last_message_id=after_id,
+            truncated=truncated,
+        )))
+    finally:
+        connection.release()
+
+
+def send_error(connection: Connection, code: str, detail: str, chat_id: Optional[int] = None):
+    connection.send(encoding.encode(schemas.ErrorEvent(code=code, detail=detail, chat_id=chat_id)))
+
+
+async def handle_new_message(user_id: str, connection: Connection, message: schemas.NewMessage):
+    if user_id != message.sender_id:
+        logger_.error(f'user id in message does not match user id in headers: {user_id}, {message.sender_id}')
+        send_error(connection, 'forbidden', 'sender_id does not match the user', message.chat_id)
+        return
+
+    # a session per message, an idle socket must not hold a pooled connection
+    async with db.async_session() as session:
+        repository = Repository(session)
+        if not await repository.is_user_in_chat(user_id, message.chat_id):
+            logger_.error(f'user {user_id} is not in chat {message.chat_id}')
+            send_error(connection, 'forbidden', 'user is not in chat', message.chat_id)
+            return
+
+        # after the membership check, which is cached, so only members spend the chat's tokens
+        if chat_rate_limiter is not None and not await chat_rate_limiter.take(str(message.chat_id)):
+            metrics.ws_throttled_frames.inc(('chat',))
+            send_error(connection, 'rate_limited', 'too many messages in chat', message.chat_id)
+            return
+
+        # no await between the lookup and add, two copies of a message can't both miss
+        client_message_id = message.client_message_id
+        pending = None
+        while client_message_id is not None:
+            saved = cache.recent_messages.get(user_id, client_message_id)
+            if saved is None:
+                pending = cache.recent_messages.add(user_id, client_message_id)
+                break
+            try:
+                # a retry of a message that is saved or being saved by an earlier attempt
+                sender.send_ack(connection, await asyncio.shield(saved), client_message_id)
+                return
+            except Exception:
+                # the earlier attempt failed and was forgotten, this one saves the message
+                continue
+
+        # looked up before the save, once the message is saved its key must stay
+        try:
+            member_ids = await repository.get_chat_member_ids(message.chat_id)
+            db_message = await (message_writer or repository).save_message(
+                chat_id=message.chat_id,
+                sender_id=user_id,
+                text=message.text,
+            )
+        except Exception as e:
+            if pending is not None:
+                # the client may retry it
+                cache.recent_messages.discard(user_id, client_message_id)
+                pending.set_exception(e)
+                pending.exception()
+            raise
+
+    message = schemas.Message(
+        id=db_message.id,
+        chat_id=db_message.chat_id,
+        sender_id=db_message.sender_id,
+        text=db_message.text,
+        is_read=False,
+        created_at=db_message.created_at,
+    )
+    if pending is not None:
+        pending.set_result(message)
+    await sender.send_message(message, member_ids, conn_manager, origin=connection, client_message_id=client_message_id)
+
+
+async def handle_read_messages(user_id: str, connection: Connection, frame: schemas.ReadMessages):
+    async with db.async_session() as session:
+        if not await Repository(session).is_user_in_chat(user_id, frame.chat_id):
+            logger_.error(f'user {user_id} is not in chat {frame.chat_id}')
+            send_error(connection, 'forbidden', 'user is not in chat', frame.chat_id)
+            return
+
+    receipt_batcher.add(frame.chat_id, user_id, frame.message_id)
+
+
+async def handle_delivered_messages(user_id: str, connection: Connection, frame: schemas.DeliveredMessages):
+    async with db.async_session() as session:
+        if not await Repository(session).is_user_in_chat(user_id, frame.chat_id):
+            logger_.error(f'user {user_id} is not in chat {frame.chat_id}')
+            send_error(connection, 'forbidden', 'user is not in chat', frame.chat_id)
+            return
+
+    receipt_batcher.add_delivered(frame.chat_id, user_id, frame.message_id)
+
+
+async def handle_typing(user_id: str, connection: Connection, frame: schemas.Typing):
+    async with db.async_session() as session:
+        member_ids = await Repository(session).get_chat_member_ids(frame.chat_id)
+    if user_id not in member_ids:
+        logger_.error(f'user {user_id} is not in chat {frame.chat_id}')
+        send_error(connection, 'forbidden', 'user is not in chat', frame.chat_id)
+        return
+
+    # typing events are best effort, repeats and throttled ones are dropped without an error
+    if not cache.recent_typing.take(frame.chat_id, user_id):
+        return
+    if chat_rate_limiter is not None and not await chat_rate_limiter.take(str(frame.chat_id)):
+        metrics.ws_throttled_frames.inc(('chat',))
+        return
+
+    await conn_manager.broadcast(
+        member_ids,
+        encoding.encode(schemas.TypingEvent(chat_id=frame.chat_id, user_id=user_id)),
+        skip=user_id,
+    )
 
 
 @app.get('/api/message/v1/chats/{chat_id}')
 async def get_chat(
         chat_id: int,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        limit: int = Query(default=100, ge=1, le=500),
+        stream: bool = False,
         x_user_id: str = Header(...),
         repository: Repository = Depends(get_repository),
 ) -> Chat:
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail='Only one of before and after can be used')
+    try:
+        before_cursor = schemas.decode_cursor(before) if before is not None else None
+        after_cursor = schemas.decode_cursor(after) if after is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
     if not await repository.is_user_in_chat(x_user_id, chat_id):
         raise HTTPException(status_code=403, detail='User is not in chat')
 
@@ -80,58 +358,104 @@ async def get_chat(
     if chat is None:
         raise HTTPException(status_code=404, detail='Chat not found')
 
-    messages = await repository.get_chat_messages(chat_id)
-    unread_messages = await repository.filter_read_messages(messages, x_user_id)
-    chat_members = await repository.get_chat_members(chat_id)
+    if stream:
+        last_read_message_ids = await repository.get_last_read_message_ids([chat_id], x_user_id)
+        member_ids = await repository.get_chat_member_ids(chat_id)
+        return StreamingResponse(
+            streaming.chat_json(
+                chat_id,
+                chat.name,
+                sorted(member_ids),
+                x_user_id,
+                last_read_message_ids.get(chat_id, 0),
+                limit,
+                before=before_cursor,
+                after=after_cursor,
+            ),
+            media_type='application/json',
+        )
+
+    # one extra message tells if there is a next page
+    messages = await repository.get_chat_messages(chat_id, limit + 1, before=before_cursor, after=after_cursor)
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit] if after_cursor is not None else messages[1:]
+        edge = messages[-1] if after_cursor is not None else messages[0]
+        next_cursor = schemas.encode_cursor(edge.created_at, edge.id)
+
+    last_read_message_ids = await repository.get_last_read_message_ids([chat_id], x_user_id)
+    member_ids = await repository.get_chat_member_ids(chat_id)
 
     return Chat(
         id=chat_id,
         name=chat.name,
         # it doesn't work with chat.chat_members because of greenlet. Why??
-        member_ids=[chat_member.user_id for chat_member in chat_members],
+        member_ids=sorted(member_ids),
         messages=[
             schemas.Message(
+                id=message.id,
                 chat_id=message.chat_id,
                 sender_id=message.sender_id,
                 text=message.text,
-                is_read=message.id not in unread_messages,
+                is_read=schemas.is_read(
+                    message.sender_id, message.id, x_user_id, last_read_message_ids.get(chat_id, 0),
+                ),
                 created_at=message.created_at,
             )
             for message in messages
-        ]
+        ],
+        next_cursor=next_cursor,
     )
 
 
 @app.get('/api/message/v1/chats')
 async def get_chats(
-        num_of_chats: int = 20,
+        num_of_chats: int = Query(default=20, ge=1, le=100),
+        before: Optional[str] = None,
+        stream: bool = False,
         repository: Repository = Depends(get_repository),
         x_user_id: str = Header(...),
 ) -> SearchChatResults:
-    res = list(await repository.get_chats_by_user_id(num_of_chats, x_user_id))
-
-    chats: dict[int, Chat] = {}
-    for row in res:
-        if row["id"] not in chats:
-            chats[row["id"]] = Chat(id=row["id"], name=row["name"], member_ids=[], messages=[])
+    try:
+        before_cursor = schemas.decode_cursor(before) if before is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
 
-        chats[row["id"]].member_ids.append(row["user_id"])
+    if stream:
+        return StreamingResponse(
+            streaming.chats_json(num_of_chats, x_user_id, before=before_cursor),
+            media_type='application/json',
+        )
 
-    messages = await repository.get_chats_messages([chat.id for chat in chats.values()])
-    unread_messages = await repository.filter_read_messages(messages, x_user_id)
+    rows = await repository.get_chats_by_user_id(num_of_chats, x_user_id, before=before_cursor)
+    member_ids = await repository.get_chats_member_ids([row['id'] for row in rows])
 
-    for message in messages:
-        chats[message.chat_id].messages.append(
-            schemas.Message(
-                chat_id=message.chat_id,
-                sender_id=message.sender_id,
-                text=message.text,
-                is_read=message.id not in unread_messages,
-                created_at=message.created_at,
-            )
+    chats = [
+        Chat(
+            id=row['id'],
+            name=row['name'],
+            member_ids=sorted(member_ids[row['id']]),
+            messages=[
+                schemas.Message(
+                    id=row['message_id'],
+                    chat_id=row['id'],
+                    sender_id=row['sender_id'],
+                    text=row['text'],
+                    is_read=schemas.is_read(
+                        row['sender_id'], row['message_id'], x_user_id, row['last_read_message_id'],
+                    ),
+                    created_at=row['created_at'],
+                )
+            ] if row['message_id'] is not None else [],
+            unread_count=row['unread_count'],
         )
+        for row in rows
+    ]
+    next_cursor = None
+    if len(rows) == num_of_chats:
+        next_cursor = schemas.encode_cursor(rows[-1]['last_message_at'], rows[-1]['id'])
 
-    return SearchChatResults(chats=list(chats.values()))
+    return SearchChatResults(chats=chats, next_cursor=next_cursor)
 
 
 @app.post('/api/message/v1/chats')
@@ -140,43 +464,70 @@ async def create_chat(
         x_user_id: str = Header(...),
         repository: Repository = Depends(get_repository),
 ) -> Chat:
-    chat_db = await repository.create_chat(new_chat.name)
-
-    try:
-        await repository.add_chat_members(chat_db.id, list(new_chat.member_ids))
-        await repository.save_message(chat_db.id, x_user_id, new_chat.first_message)
-    except Exception as e:
-        logger_.exception(f'error creating chat: {e}')
-        await repository.delete_chat(chat_db.id)
-        raise e
-
-    db_messages = await repository.get_chats_messages([chat_db.id])
-    chat_members = await repository.get_chat_members(chat_db.id)
+    member_ids = list(dict.fromkeys(new_chat.member_ids))
+    chat_db, db_message = await repository.create_chat_with_message(
+        new_chat.name, member_ids, x_user_id, new_chat.first_message,
+    )
 
     first_message = schemas.Message(
-        chat_id=db_messages[0].chat_id,
-        sender_id=db_messages[0].sender_id,
-        text=db_messages[0].text,
+        id=db_message.id,
+        chat_id=db_message.chat_id,
+        sender_id=db_message.sender_id,
+        text=db_message.text,
         is_read=False,
-        created_at=db_messages[0].created_at,
+        created_at=db_message.created_at,
     )
-    # todo why I cannot use chat_db.chat_members here? it argues on greenlet.. something related to async
-    await sender.send_message(first_message, chat_members, conn_manager)
+    await sender.send_message(first_message, member_ids, conn_manager)
 
     return Chat(
         id=chat_db.id,
         name=chat_db.name,
-        member_ids=new_chat.member_ids,
+        member_ids=member_ids,
+        messages=[first_message.model_copy(update={'is_read': True})],
+    )
+
+
+@app.get('/api/message/v1/unread')
+async def get_unread_counts(
+        repository: Repository = Depends(get_repository),
+        x_user_id: str = Header(...),
+) -> UnreadCounts:
+    unread_counts = await repository.get_unread_counts(x_user_id)
+    return UnreadCounts(chats=unread_counts, total=sum(unread_counts.values()))
+
+
+@app.get('/api/message/v1/search')
+async def search_messages(
+        q: str = Query(min_length=1, max_length=255),
+        limit: int = Query(default=20, ge=1, le=100),
+        after: Optional[str] = None,
+        repository: Repository = Depends(get_repository),
+        x_user_id: str = Header(...),
+) -> SearchMessageResults:
+    try:
+        after_cursor = schemas.decode_cursor(after) if after is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+    rows = await repository.search_messages(x_user_id, q, limit, after=after_cursor)
+    next_cursor = None
+    if len(rows) == limit:
+        message, _, score = rows[-1]
+        next_cursor = schemas.encode_cursor(score, message.id)
+
+    return SearchMessageResults(
         messages=[
             schemas.Message(
+                id=message.id,
                 chat_id=message.chat_id,
                 sender_id=message.sender_id,
                 text=message.text,
-                is_read=True,
+                is_read=schemas.is_read(message.sender_id, message.id, x_user_id, last_read_message_id),
                 created_at=message.created_at,
             )
-            for message in db_messages
-        ]
+            for message, last_read_message_id, _ in rows
+        ],
+        next_cursor=next_cursor,
     )
 
 
@@ -190,4 +541,8 @@ async def mark_chat_as_read(
         raise HTTPException(status_code=403, detail='User is not in chat')
 
     await repository.read_all_messages(chat_id, x_user_id)
+    await conn_manager.broadcast(
+        [x_user_id],
+        encoding.encode(schemas.UnreadEvent(chat_id=chat_id, unread_count=0)),
+    )
     return {"message": "ok"}
@@ -1,31 +1,316 @@
 import asyncio
+import time
+from collections import deque
+from typing import Callable, Collection, Iterable, Optional
 
 from fastapi import WebSocket
 
+from mess_message import logger, metrics, schemas
+from mess_message.bus import Bus, LocalBus
+from mess_message.encoding import Frame, encode
+from mess_message.fanout import FanoutPool
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+
+
+class Connection:
+    """A socket with its own outbound queue, so fan-out never waits on the network."""
+
+    __slots__ = (
+        'key', 'device_id', 'websocket', 'overflow_policy', 'queue', 'held', 'dropped', 'closed', 'last_seen',
+        '_on_close', '_writer', '_closing',
+    )
+
+    def __init__(
+            self,
+            key: str,
+            websocket: WebSocket,
+            max_queue_size: int,
+            overflow_policy: str,
+            on_close: Callable[['Connection'], None],
+            device_id: Optional[str] = None,
+            hold: bool = False,
+    ):
+        self.key = key
+        # a device keeps one socket, a reconnect replaces the previous one
+        self.device_id = device_id
+        self.websocket = websocket
+        self.overflow_policy = overflow_policy
+        self.queue: asyncio.Queue[Frame] = asyncio.Queue(max_queue_size)
+        # frames sent while held wait here until `release`, bounded like the queue.
+        # `put` still goes to the queue
+        self.held: Optional[deque[Frame]] = deque() if hold else None
+        self.dropped = 0
+        self.closed = False
+        # monotonic time of the last frame received from the client
+        self.last_seen = time.monotonic()
+        self._on_close = on_close
+        # resolved once the connection is closed, wakes up `put`
+        self._closing = asyncio.get_running_loop().create_future()
+        self._writer = asyncio.create_task(self._write())
+
+    def send(self, message: Frame):
+        if self.closed:
+            return
+
+        if self.held is not None:
+            full = 0 < self.queue.maxsize <= len(self.held)
+        else:
+            full = self.queue.full()
+        if full:
+            if self.overflow_policy == DISCONNECT:
+                logger_.warning(f'disconnecting slow consumer: {self.key}')
+                self.evict(1013, 'slow')
+                return
+
+            if self.held is not None:
+                self.held.popleft()
+            else:
+                self.queue.get_nowait()
+            self.dropped += 1
+
+        if self.held is not None:
+            self.held.append(message)
+        else:
+            self.queue.put_nowait(message)
+
+    async def put(self, message: Frame) -> bool:
+        """Waits for space in the queue instead of applying the overflow policy.
+        False when the connection is or gets closed before there is space."""
+        if self.closed:
+            return False
+        if not self.queue.full():
+            self.queue.put_nowait(message)
+            return True
+
+        put = asyncio.ensure_future(self.queue.put(message))
+        try:
+            await asyncio.wait((put, self._closing), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put.cancel()
+        return put.done() and not put.cancelled()
+
+    def release(self):
+        """Sends the held frames and stops holding."""
+        held, self.held = self.held, None
+        for message in held or ():
+            self.send(message)
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+
+        self._shutdown()
+        await self._close_websocket(code)
+
+    def evict(self, code: int, reason: str):
+        """Closes without waiting for the peer, which may never answer."""
+        if self.closed:
+            return
+
+        metrics.ws_evicted.inc((reason,))
+        self._shutdown()
+        asyncio.create_task(self._close_websocket(code))
+
+    def _shutdown(self):
+        self._set_closed()
+        self._writer.cancel()
+        self._on_close(self)
+
+    def _set_closed(self):
+        self.closed = True
+        if not self._closing.done():
+            self._closing.set_result(None)
+
+    async def _close_websocket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            logger_.debug(f'cannot close websocket of {self.key}: {e}')
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                started = time.perf_counter() if metrics.sample() else None
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+                if started is not None:
+                    metrics.ws_send_duration.observe(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger_.error(f'websocket send failed: {self.key}, {e}')
+            metrics.ws_evicted.inc(('send_failed',))
+            self._set_closed()
+            self._on_close(self)
+            await self._close_websocket(1011)
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}
-        self.lock = asyncio.Lock()
+    """Open sockets per user.
+
+    Every `ping_interval` seconds a ping frame is queued to each connection and
+    connections that sent nothing for `idle_timeout` seconds are closed. A user
+    keeps at most `max_connections_per_key` sockets, the oldest ones are closed
+    first. Broadcasts to at least `fanout_threshold` users are handed to a
+    FanoutPool. Zero disables any of these.
+    """
+
+    def __init__(
+            self,
+            bus: Optional[Bus] = None,
+            max_queue_size: int = 256,
+            overflow_policy: str = DROP_OLDEST,
+            ping_interval: float = 0,
+            idle_timeout: float = 0,
+            max_connections_per_key: int = 0,
+            fanout_threshold: int = 0,
+            fanout_shards: int = 4,
+            fanout_chunk_size: int = 500,
+    ):
+        if overflow_policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f'unknown overflow policy: {overflow_policy}')
+
+        self.active_connections: dict[str, list[Connection]] = {}
+        self.bus = bus or LocalBus()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_connections_per_key = max_connections_per_key
+        self.fanout_threshold = fanout_threshold
+        self.fanout = FanoutPool(
+            self._deliver, self.bus.publish, fanout_shards, fanout_chunk_size,
+        ) if fanout_threshold > 0 else None
+        # dropped counters of already closed connections
+        self._dropped = 0
+        self._reaper: Optional[asyncio.Task] = None
 
-    async def connect(self, key: str, websocket: WebSocket):
+    async def start(self):
+        await self.bus.start(self._deliver)
+        if self.fanout is not None:
+            await self.fanout.start()
+        if self.ping_interval > 0:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self.fanout is not None:
+            await self.fanout.stop()
+        await self.bus.stop()
+
+    async def connect(
+            self,
+            key: str,
+            websocket: WebSocket,
+            device_id: Optional[str] = None,
+            hold: bool = False,
+    ) -> Connection:
+        """With `hold` broadcasts to the connection are kept back until it's released."""
         await websocket.accept()
-        await self._add(key, websocket)
+
+        connection = Connection(
+            key, websocket, self.max_queue_size, self.overflow_policy, self._remove, device_id, hold,
+        )
+        if key not in self.active_connections:
+            self.active_connections[key] = []
+            await self.bus.register(key)
+
+        connections = self.active_connections[key]
+        if device_id is not None:
+            for previous in [c for c in connections if c.device_id == device_id]:
+                logger_.info(f'closing the previous connection of device {device_id} of {key}')
+                previous.evict(1000, 'replaced')
+        if self.max_connections_per_key > 0:
+            for oldest in connections[:max(0, len(connections) - self.max_connections_per_key + 1)]:
+                logger_.info(f'closing the oldest connection of {key}, too many connections')
+                oldest.evict(1008, 'limit')
+
+        # the list is replaced by _remove when the last connection closes
+        self.active_connections.setdefault(key, connections).append(connection)
+        return connection
 
     async def disconnect(self, key: str, websocket: WebSocket):
-        async with self.lock:
-            if key in self.active_connections:
-                self.active_connections[key].remove(websocket)
-
-    async def send_personal_message(self, recipient_username: str, message: str):
-        async with self.lock:
-            if recipient_username in self.active_connections:
-                for connection in self.active_connections[recipient_username]:
-                    await connection.send_text(message)
-
-    async def _add(self, key: str, websocket: WebSocket):
-        async with self.lock:
-            if key not in self.active_connections:
-                self.active_connections[key] = []
-
-            self.active_connections[key].append(websocket)
+        for connection in self.active_connections.get(key, ()):
+            if connection.websocket is websocket:
+                await connection.close()
+                break
+
+    async def send_personal_message(self, recipient_username: str, message: Frame):
+        await self.broadcast([recipient_username], message)
+
+    async def broadcast(
+            self,
+            recipients: Collection[str],
+            message: Frame,
+            exclude: Optional[Connection] = None,
+            skip: Optional[str] = None,
+    ):
+        """Sends to every socket of the recipients but `exclude`, `skip` is a recipient left out."""
+        if self.fanout is not None and len(recipients) >= self.fanout_threshold:
+            # returns right away, the recipients are not even copied here
+            self.fanout.submit(recipients, message, skip, exclude)
+            return
+
+        recipients = [recipient for recipient in recipients if recipient != skip]
+        self._deliver(recipients, message, exclude)
+        await self.bus.publish(recipients, message)
+
+    def queue_stats(self) -> dict:
+        depths = [
+            connection.queue.qsize()
+            for connections in self.active_connections.values()
+            for connection in connections
+        ]
+        return {
+            'connections': len(depths),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'dropped': self._dropped + sum(
+                connection.dropped
+                for connections in self.active_connections.values()
+                for connection in connections
+            ),
+        }
+
+    def _deliver(self, recipients: Iterable[str], message: Frame, exclude: Optional[Connection] = None):
+        for recipient in recipients:
+            for connection in self.active_connections.get(recipient, ()):
+                if connection is not exclude:
+                    connection.send(message)
+
+    def _remove(self, connection: Connection):
+        connections = self.active_connections.get(connection.key)
+        if connections is None or connection not in connections:
+            return
+
+        connections.remove(connection)
+        self._dropped += connection.dropped
+        if not connections:
+            del self.active_connections[connection.key]
+            asyncio.create_task(self._unregister(connection.key))
+
+    async def _unregister(self, key: str):
+        # the user may have reconnected in the meantime
+        if key not in self.active_connections:
+            await self.bus.unregister(key)
+
+    async def _reap(self):
+        ping = encode(schemas.Ping())
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            deadline = time.monotonic() - self.idle_timeout
+            for connections in list(self.active_connections.values()):
+                for connection in list(connections):
+                    if self.idle_timeout > 0 and connection.last_seen < deadline:
+                        logger_.info(f'closing idle connection: {connection.key}')
+                        connection.evict(1001, 'idle')
+                    else:
+                        connection.send(ping)
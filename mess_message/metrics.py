@@ -0,0 +1,185 @@
+"""In-process metrics exposed in the prometheus text format on /metrics.
+
+Counters are exact, timings are sampled (see `metrics_sample_rate`). Label
+values are tuples, a series is allocated once and then updated in place.
+"""
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import HTTPConnection
+
+from mess_message import settings
+
+# set by the route dependency and by instrumented Repository methods,
+# queries outside of a request are attributed to 'background'
+route_label: ContextVar[str] = ContextVar('route', default='background')
+method_label: ContextVar[str] = ContextVar('method', default='')
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Sampler:
+    def __init__(self, rate: float):
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._n = 0
+
+    def __call__(self) -> bool:
+        if not self.every:
+            return False
+
+        self._n += 1
+        if self._n >= self.every:
+            self._n = 0
+            return True
+        return False
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}', *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def _labels(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float] = lambda: 0):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def _samples(self) -> list[str]:
+        return [f'{self.name} {self.callback()}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # per bucket counts (not cumulative) followed by the +Inf bucket, sum and count
+        self.series: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 3)
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                samples.append(f'{self.name}_bucket{self._labels(labels, le)} {cumulative}')
+            samples.append(f'{self.name}_sum{self._labels(labels)} {series[-2]}')
+            samples.append(f'{self.name}_count{self._labels(labels)} {series[-1]}')
+        return samples
+
+
+sample = Sampler(settings.get_settings().metrics_sample_rate)
+
+db_queries = Counter('db_queries_total', 'SQL statements executed', ('route', 'method'))
+db_query_duration = Histogram(
+    'db_query_duration_seconds', 'Sampled SQL statement duration', LATENCY_BUCKETS, ('route', 'method'),
+)
+ws_connections = Gauge('ws_connections', 'Open websocket connections')
+ws_send_queued = Gauge('ws_send_queued', 'Frames waiting in websocket send queues')
+ws_send_dropped = Gauge('ws_send_dropped_total', 'Frames dropped because a send queue was full')
+ws_evicted = Counter('ws_evicted_total', 'Websocket connections closed by the server', ('reason',))
+ws_throttled_frames = Counter(
+    'ws_throttled_frames_total', 'Inbound websocket frames rejected by rate limits', ('scope',),
+)
+ws_send_duration = Histogram('ws_send_duration_seconds', 'Sampled duration of a websocket send', LATENCY_BUCKETS)
+fanout_size = Histogram('fanout_recipients', 'Recipients of a sent message', SIZE_BUCKETS)
+fanout_queued = Gauge('fanout_queued', 'Large group broadcasts and shard chunks waiting in the fan-out pool')
+fanout_duration = Histogram('fanout_duration_seconds', 'Sampled time to encode and enqueue a message', LATENCY_BUCKETS)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+async def track_route(connection: HTTPConnection):
+    """App level dependency, labels queries with the name of the endpoint."""
+    route_label.set(connection.scope['endpoint'].__name__)
+
+
+def instrument(cls):
+    """Labels queries issued by public coroutine methods of the class with the method name."""
+    for name, attr in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.iscoroutinefunction(attr):
+            setattr(cls, name, _with_method_label(name, attr))
+    return cls
+
+
+def _with_method_label(name: str, method):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        token = method_label.set(name)
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            method_label.reset(token)
+
+    return wrapper
+
+
+def instrument_engine(engine: Engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        labels = (route_label.get(), method_label.get())
+        db_queries.inc(labels)
+        if sample():
+            conn.info['query_started'] = (labels, time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop('query_started', None)
+        if started is not None:
+            labels, started_at = started
+            db_query_duration.observe(time.perf_counter() - started_at, labels)
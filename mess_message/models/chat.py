@@ -1,6 +1,6 @@
 from datetime import datetime, timezone
 
-from sqlalchemy import Integer, String, ForeignKey, PrimaryKeyConstraint, Float
+from sqlalchemy import Integer, String, ForeignKey, PrimaryKeyConstraint, Float, Index
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 
 from mess_message.models import Base
@@ -11,20 +11,37 @@ class Chat(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(255), nullable=True)
+    # denormalized on every message for the inbox, 0 while the chat has no messages
+    last_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    last_message_at: Mapped[float] = mapped_column(Float, nullable=False, default=0, server_default='0')
+    # digest of the sorted member ids, set only for direct chats so a pair has at most one
+    member_key: Mapped[str] = mapped_column(String(64), nullable=True)
+    # number of messages ever sent to the chat, archived ones included
+    message_seq: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
 
     chat_members: Mapped['ChatMember'] = relationship("ChatMember", back_populates="chat", lazy='select')
 
+    __table_args__ = (
+        Index('ix_chats_member_key', 'member_key', unique=True),
+    )
+
 
 class ChatMember(Base):
     __tablename__ = 'chat_members'
 
     chat_id: Mapped[int] = mapped_column(Integer, ForeignKey('chats.id'))
     user_id: Mapped[str] = mapped_column(String(150), nullable=False)
+    # messages up to this id are read by the member, 0 if nothing is read yet
+    last_read_message_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
+    # the chat's message_seq at the read cursor, the unread count is message_seq - read_seq.
+    # Sending a message moves the sender's cursor, so all later messages are the others'
+    read_seq: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
 
     chat: Mapped['Chat'] = relationship("Chat", back_populates="chat_members", lazy='select')
 
     __table_args__ = (
         PrimaryKeyConstraint('chat_id', 'user_id', name='chat_member_pk'),
+        Index('ix_chat_members_user_id', 'user_id'),
     )
 
 
@@ -37,14 +54,29 @@ class Message(Base):
     text: Mapped[str] = mapped_column(String(255), nullable=False)
     created_at: Mapped[float] = mapped_column(Float, default=lambda: datetime.now(timezone.utc).timestamp())
 
+    __table_args__ = (
+        # chat history is paginated by (created_at, id) inside a chat
+        Index('ix_messages_chat_id_created_at_id', 'chat_id', 'created_at', 'id'),
+        # unread messages of a chat are the ones after the member's read cursor
+        Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+        # the archiver looks for messages older than the retention
+        Index('ix_messages_created_at', 'created_at'),
+    )
+
 
-class UnreadMessage(Base):
-    __tablename__ = 'unread_messages'
+class ArchivedSegment(Base):
+    __tablename__ = 'archived_segments'
 
-    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey('chats.id'))
-    message_id: Mapped[int] = mapped_column(Integer, ForeignKey('messages.id'))
-    user_id: Mapped[str] = mapped_column(String(150), nullable=False)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    chat_id: Mapped[int] = mapped_column(Integer, ForeignKey('chats.id'), nullable=False)
+    # relative to the archive directory
+    path: Mapped[str] = mapped_column(String(255), nullable=False)
+    first_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    first_created_at: Mapped[float] = mapped_column(Float, nullable=False)
+    last_created_at: Mapped[float] = mapped_column(Float, nullable=False)
+    message_count: Mapped[int] = mapped_column(Integer, nullable=False)
 
     __table_args__ = (
-        PrimaryKeyConstraint('message_id', 'user_id', name='unread_messages_pk'),
+        Index('ix_archived_segments_chat_id_first_id', 'chat_id', 'first_id', unique=True),
     )
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+
+from mess_message.bus import Bus, BrokerBus
+from mess_message.settings import Settings
+
+
+class RateLimiter:
+    """Token buckets by key, in process.
+
+    A bucket holds up to `burst` tokens and refills at `rate` tokens per second.
+    Buckets are kept in LRU order and the least recently used ones are dropped
+    above `max_keys`, a dropped bucket comes back full.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, monotonic time of the last update)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str) -> bool:
+        return self.take_nowait(key)
+
+    def take_nowait(self, key: str) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated_at = bucket
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class SharedRateLimiter:
+    """The same buckets kept by the broker, so a limit holds across workers."""
+
+    def __init__(self, bus: BrokerBus, name: str, rate: float, burst: int):
+        self.bus = bus
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    async def take(self, key: str) -> bool:
+        return await self.bus.take(f'{self.name}:{key}', self.rate, self.burst)
+
+
+def get_rate_limiter(settings: Settings, bus: Bus, name: str, rate: float, burst: int):
+    if settings.rate_limit_backend == 'local':
+        return RateLimiter(rate, burst, settings.rate_limit_max_keys)
+    if settings.rate_limit_backend == 'broker':
+        if not isinstance(bus, BrokerBus):
+            raise ValueError("rate_limit_backend 'broker' requires delivery_backend 'broker'")
+        return SharedRateLimiter(bus, name, rate, burst)
+    raise ValueError(f'unknown rate limit backend: {settings.rate_limit_backend}')
@@ -0,0 +1,134 @@
+import asyncio
+from typing import Callable, Collection, Optional
+
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from mess_message import encoding, logger, schemas
+from mess_message.managers import ConnectionManager
+from mess_message.repository import Repository
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+
+class ReadReceiptBatcher:
+    """Coalesces read and delivery receipts of all sockets of a worker over a short window.
+
+    A flush writes every read cursor in one transaction and sends one read event
+    and one delivered event per chat to its other members, however many receipts
+    were received for it, and the new unread counts to the readers. Delivery
+    receipts are only relayed, they are not stored.
+    """
+
+    def __init__(
+            self,
+            session_factory: async_sessionmaker[AsyncSession],
+            connection_manager: ConnectionManager,
+            window: float = 0.5,
+    ):
+        self.session_factory = session_factory
+        self.connection_manager = connection_manager
+        self.window = window
+        # chat_id -> user_id -> the last read message
+        self.pending: dict[int, dict[str, int]] = {}
+        # chat_id -> user_id -> the last delivered message
+        self.delivered: dict[int, dict[str, int]] = {}
+        # sleeping until the window ends, cancelled on stop
+        self._task: Optional[asyncio.Task] = None
+        # flushing, awaited on stop
+        self._flushing: set[asyncio.Task] = set()
+
+    def add(self, chat_id: int, user_id: str, message_id: int):
+        self._add(self.pending, chat_id, user_id, message_id)
+
+    def add_delivered(self, chat_id: int, user_id: str, message_id: int):
+        self._add(self.delivered, chat_id, user_id, message_id)
+
+    def _add(self, receipts: dict[int, dict[str, int]], chat_id: int, user_id: str, message_id: int):
+        users = receipts.setdefault(chat_id, {})
+        if message_id > users.get(user_id, 0):
+            users[user_id] = message_id
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._flushing:
+            await asyncio.wait(self._flushing)
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        delivered, self.delivered = self.delivered, {}
+        if not pending and not delivered:
+            return
+
+        unread_counts = {}
+        try:
+            async with self.session_factory() as session:
+                repository = Repository(session)
+                if pending:
+                    # only the cursors that moved are sent, the rest were refused or already there
+                    moved = await repository.read_messages([
+                        (chat_id, user_id, message_id)
+                        for chat_id, readers in pending.items()
+                        for user_id, message_id in readers.items()
+                    ])
+                    pending = {}
+                    for chat_id, user_id, message_id in moved:
+                        pending.setdefault(chat_id, {})[user_id] = message_id
+                    if moved:
+                        unread_counts = await repository.get_members_unread_counts([
+                            (chat_id, user_id) for chat_id, user_id, _ in moved
+                        ])
+                member_ids = await repository.get_chats_member_ids(list(pending.keys() | delivered.keys()))
+        except Exception as e:
+            logger_.exception(f'cannot save read receipts of {len(pending)} chats: {e}')
+            return
+
+        for chat_id, readers in pending.items():
+            await self._send_receipts(
+                member_ids[chat_id],
+                readers,
+                lambda receipts: schemas.ReadEvent(chat_id=chat_id, read_up_to=receipts),
+            )
+        for chat_id, recipients in delivered.items():
+            await self._send_receipts(
+                member_ids[chat_id],
+                recipients,
+                lambda receipts: schemas.DeliveredEvent(chat_id=chat_id, delivered_up_to=receipts),
+            )
+        for (chat_id, user_id), unread_count in unread_counts.items():
+            await self.connection_manager.broadcast(
+                [user_id],
+                encoding.encode(schemas.UnreadEvent(chat_id=chat_id, unread_count=unread_count)),
+            )
+
+    async def _send_receipts(
+            self,
+            member_ids: Collection[str],
+            receipts: dict[str, int],
+            event: Callable[[dict[str, int]], BaseModel],
+    ):
+        # members get the receipts of the others, never their own
+        await self.connection_manager.broadcast(
+            [member_id for member_id in member_ids if member_id not in receipts],
+            encoding.encode(event(receipts)),
+        )
+        if len(receipts) > 1:
+            for user_id in receipts:
+                others = {other: message_id for other, message_id in receipts.items() if other != user_id}
+                await self.connection_manager.broadcast([user_id], encoding.encode(event(others)))
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._task = None
+        task = asyncio.current_task()
+        self._flushing.add(task)
+        try:
+            await self.flush()
+        finally:
+            self._flushing.discard(task)
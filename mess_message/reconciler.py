@@ -0,0 +1,59 @@
+import asyncio
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from mess_message import logger
+from mess_message.repository import Repository
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+
+class UnreadReconciler:
+    """Recomputes read sequences of chat members from messages and read cursors.
+
+    Sequences are maintained on every write, this fixes the unread counts that
+    drifted. Every `interval` seconds all chats are walked in id order,
+    `batch_size` chats per transaction.
+    """
+
+    def __init__(
+            self,
+            session_factory: async_sessionmaker[AsyncSession],
+            batch_size: int = 500,
+            interval: float = 3600.0,
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger_.exception(f'unread counters reconciliation failed: {e}')
+
+    async def reconcile(self) -> int:
+        last_chat_id = 0
+        fixed = 0
+        while True:
+            async with self.session_factory() as session:
+                result = await Repository(session).reconcile_unread_counts(last_chat_id, self.batch_size)
+            if result is None:
+                break
+            last_chat_id, count = result
+            fixed += count
+
+        if fixed:
+            logger_.warning(f'fixed {fixed} unread counters')
+        return fixed
@@ -1,162 +1,653 @@
+import hashlib
+import re
+from collections import Counter
 from typing import Sequence, Optional
 
 from fastapi import Depends
-from sqlalchemy import select, delete, func
-from sqlalchemy.ext.asyncio import AsyncSession
-
+from sqlalchemy import Boolean, Integer, select, delete, func, insert, update, tuple_, bindparam
+from sqlalchemy import Select, and_, case, column, literal_column, or_, table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncResult
+from sqlalchemy.orm import aliased
+
+from mess_message import metrics
+from mess_message.archive import SegmentStore, segment_store
+from mess_message.cache import MembershipCache, membership_cache
 from mess_message.db import get_session
-from mess_message.models.chat import Message, Chat, ChatMember, UnreadMessage
+from mess_message.models.chat import Message, Chat, ChatMember, ArchivedSegment
+
+
+# dev databases search through the messages_fts table, postgres through an expression index
+# on to_tsvector('simple', text), both are created by migrations
+messages_fts = table('messages_fts', column('rowid', Integer))
+SEARCH_CONFIG = literal_column("'simple'")
+MEMBER_IDS_CHUNK_SIZE = 1000
 
 
+def direct_chat_key(member_user_ids: Sequence[str], sender_id: str) -> Optional[str]:
+    member_user_ids = set(member_user_ids)
+    if len(member_user_ids) != 2 or sender_id not in member_user_ids:
+        return None
+    return hashlib.sha256('\x1f'.join(sorted(member_user_ids)).encode()).hexdigest()
+
+
+@metrics.instrument
 class Repository:
-    def __init__(self, session: AsyncSession):
+    def __init__(
+            self,
+            session: AsyncSession,
+            members_cache: MembershipCache = membership_cache,
+            archive_store: Optional[SegmentStore] = segment_store,
+    ):
         self.session = session
+        self.members_cache = members_cache
+        self.archive_store = archive_store
 
     async def save_message(self, chat_id: int, sender_id: str, text: str) -> Message:
-        message = Message(
-            chat_id=chat_id,
-            sender_id=sender_id,
-            text=text,
-        )
-        self.session.add(message)
-        await self.session.commit()
-        await self.session.refresh(message)
-
-        await self.add_to_unread_messages(message)
-
-        return message
+        return (await self.save_messages([(chat_id, sender_id, text)]))[0]
 
-    async def add_to_unread_messages(self, message: Message):
-        chat_members = (await self.session.scalars(
-            select(ChatMember.user_id)
-            .filter(ChatMember.chat_id == message.chat_id, ChatMember.user_id != message.sender_id)
+    async def save_messages(self, messages: Sequence[tuple[int, str, str]]) -> list[Message]:
+        # ids and creation times come back with the insert instead of a refresh
+        rows = (await self.session.execute(
+            insert(Message).returning(Message.id, Message.created_at, sort_by_parameter_order=True),
+            [{'chat_id': chat_id, 'sender_id': sender_id, 'text': text} for chat_id, sender_id, text in messages],
         )).all()
 
-        self.session.add_all(
-            [UnreadMessage(chat_id=message.chat_id, message_id=message.id, user_id=user_id) for user_id in chat_members]
+        # per chat the number of messages and the last one, per sender in a chat their last
+        # message and how many of the batch come after it
+        counts = Counter()
+        last_messages = {}
+        senders = {}
+        for row, (chat_id, sender_id, _) in zip(rows, messages):
+            counts[chat_id] += 1
+            last_messages[chat_id] = row
+            senders[chat_id, sender_id] = (row.id, counts[chat_id])
+        newer = Chat.last_message_id.is_(None) | (Chat.last_message_id < bindparam('message_id'))
+        await self.session.execute(
+            update(Chat.__table__)
+            .where(Chat.id == bindparam('chat_id'))
+            .values(
+                message_seq=Chat.message_seq + bindparam('count'),
+                last_message_id=case((newer, bindparam('message_id')), else_=Chat.last_message_id),
+                last_message_at=case((newer, bindparam('created_at')), else_=Chat.last_message_at),
+            ),
+            [
+                {'chat_id': chat_id, 'count': counts[chat_id], 'message_id': row.id, 'created_at': row.created_at}
+                for chat_id, row in sorted(last_messages.items())
+            ],
         )
-        await self.session.commit()
-
-    async def filter_read_messages(self, messages: Sequence[Message], user_id: str) -> Sequence[Message]:
-        return (await self.session.scalars(
-            select(UnreadMessage.message_id)
-            .filter(
-                UnreadMessage.message_id.in_([message.id for message in messages]),
-                UnreadMessage.user_id == user_id,
+        # a sender has read the chat up to their own message, one row per sender whatever
+        # the size of the chat. Sorted so concurrent batches lock rows in the same order
+        await self.session.execute(
+            update(ChatMember.__table__)
+            .where(
+                ChatMember.chat_id == bindparam('b_chat_id'),
+                ChatMember.user_id == bindparam('b_sender_id'),
+                ChatMember.last_read_message_id < bindparam('b_message_id'),
             )
-        )).all()
-
-    async def get_messages(self, chat_id: int, number: int = 10) -> Sequence[Message]:
-        return (await self.session.scalars(select(Message).filter_by(chat_id=chat_id).limit(number))).all()
-
-    async def chat_exists(self, chat_name: str) -> bool:
-        return (await self.session.scalars(select(Chat).filter_by(name=chat_name))).first() is not None
+            .values(
+                last_read_message_id=bindparam('b_message_id'),
+                read_seq=select(Chat.message_seq).where(Chat.id == bindparam('b_chat_id')).scalar_subquery()
+                - bindparam('b_later'),
+            ),
+            [
+                {
+                    'b_chat_id': chat_id,
+                    'b_sender_id': sender_id,
+                    'b_message_id': message_id,
+                    'b_later': counts[chat_id] - position,
+                }
+                for (chat_id, sender_id), (message_id, position) in sorted(senders.items())
+            ],
+        )
+        await self.session.commit()
 
-    async def create_chat(self, name: str) -> Chat:
-        chat = Chat(
-            name=name,
+        return [
+            Message(id=row.id, chat_id=chat_id, sender_id=sender_id, text=text, created_at=row.created_at)
+            for row, (chat_id, sender_id, text) in zip(rows, messages)
+        ]
+
+    async def get_last_read_message_ids(self, chat_ids: Sequence[int], user_id: str) -> dict[int, int]:
+        return dict((await self.session.execute(
+            select(ChatMember.chat_id, ChatMember.last_read_message_id)
+            .filter(ChatMember.chat_id.in_(chat_ids), ChatMember.user_id == user_id)
+        )).tuples().all())
+
+    async def create_chat_with_message(
+            self,
+            name: Optional[str],
+            member_user_ids: Sequence[str],
+            sender_id: str,
+            text: str,
+    ) -> tuple[Chat, Message]:
+        # a direct chat between the same pair is reused, the message goes to the existing one
+        member_key = direct_chat_key(member_user_ids, sender_id)
+        if member_key is not None:
+            chat = await self.get_chat_by_member_key(member_key)
+            if chat is not None:
+                return chat, await self.save_message(chat.id, sender_id, text)
+
+        try:
+            return await self._create_chat_with_message(name, member_user_ids, sender_id, text, member_key)
+        except IntegrityError:
+            await self.session.rollback()
+            if member_key is None:
+                raise
+            # a concurrent request created the same direct chat first
+            chat = await self.get_chat_by_member_key(member_key)
+            return chat, await self.save_message(chat.id, sender_id, text)
+
+    async def _create_chat_with_message(
+            self,
+            name: Optional[str],
+            member_user_ids: Sequence[str],
+            sender_id: str,
+            text: str,
+            member_key: Optional[str],
+    ) -> tuple[Chat, Message]:
+        # chat, members, the first message and read state in one transaction,
+        # a failure leaves nothing behind
+        chat_id = (await self.session.execute(
+            insert(Chat).values(name=name, member_key=member_key, message_seq=1).returning(Chat.id)
+        )).scalar_one()
+        message_id, created_at = (await self.session.execute(
+            insert(Message)
+            .values(chat_id=chat_id, sender_id=sender_id, text=text)
+            .returning(Message.id, Message.created_at)
+        )).one()
+        await self.session.execute(
+            insert(ChatMember),
+            [
+                {
+                    'chat_id': chat_id,
+                    'user_id': user_id,
+                    'last_read_message_id': message_id if user_id == sender_id else 0,
+                    'read_seq': 1 if user_id == sender_id else 0,
+                }
+                for user_id in member_user_ids
+            ],
+        )
+        await self.session.execute(
+            update(Chat)
+            .where(Chat.id == chat_id)
+            .values(last_message_id=message_id, last_message_at=created_at)
         )
-        self.session.add(chat)
         await self.session.commit()
-        await self.session.refresh(chat)
 
-        return chat
+        # other workers may have cached the chat as empty before it existed
+        self.members_cache.invalidate(chat_id)
+        self.members_cache.set(chat_id, frozenset(member_user_ids))
+
+        return (
+            Chat(
+                id=chat_id,
+                name=name,
+                last_message_id=message_id,
+                last_message_at=created_at,
+                member_key=member_key,
+                message_seq=1,
+            ),
+            Message(id=message_id, chat_id=chat_id, sender_id=sender_id, text=text, created_at=created_at),
+        )
 
     async def get_chat(self, chat_id: int) -> Optional[Chat]:
         return (await self.session.scalars(select(Chat).filter_by(id=chat_id))).first()
 
-    async def add_chat_members(self, chat_id: int, member_user_ids: Sequence[str]):
-        chat_members = [ChatMember(chat_id=chat_id, user_id=user_id) for user_id in member_user_ids]
-        self.session.add_all(chat_members)
-        await self.session.commit()
+    async def get_chat_by_member_key(self, member_key: str) -> Optional[Chat]:
+        return (await self.session.scalars(select(Chat).filter_by(member_key=member_key))).first()
+
+    async def get_chat_member_ids(self, chat_id: int) -> frozenset[str]:
+        member_ids = self.members_cache.get(chat_id)
+        if member_ids is None:
+            # streamed in chunks, a large group is never buffered as rows
+            result = await self.session.stream_scalars(
+                select(ChatMember.user_id)
+                .filter_by(chat_id=chat_id)
+                .execution_options(yield_per=MEMBER_IDS_CHUNK_SIZE)
+            )
+            loaded = set()
+            async for user_ids in result.partitions():
+                loaded.update(user_ids)
+            member_ids = frozenset(loaded)
+            self.members_cache.set(chat_id, member_ids)
 
-    async def get_chat_members(self, chat_id: int) -> Sequence[ChatMember]:
-        return (await self.session.scalars(select(ChatMember).filter_by(chat_id=chat_id))).all()
+        return member_ids
 
     async def is_user_in_chat(self, user_id: str, chat_id: int) -> bool:
-        return (
-            await self.session.scalars(
-                select(ChatMember).filter_by(chat_id=chat_id, user_id=user_id))).first() is not None
+        return user_id in await self.get_chat_member_ids(chat_id)
+
+    async def get_chats_by_user_id(
+            self,
+            num_of_chats: int,
+            user_id: str,
+            before: Optional[tuple[float, int]] = None,
+    ) -> Sequence:
+        result = await self.session.execute(self._chats_by_user_id_query(num_of_chats, user_id, before))
+        return result.mappings().all()
 
-    async def delete_chat(self, chat_id: int):
-        await self.session.execute(
-            delete(UnreadMessage).where(UnreadMessage.chat_id == chat_id)
+    async def stream_chats_by_user_id(
+            self,
+            num_of_chats: int,
+            user_id: str,
+            before: Optional[tuple[float, int]] = None,
+    ) -> AsyncResult:
+        return await self.session.stream(self._chats_by_user_id_query(num_of_chats, user_id, before))
+
+    @staticmethod
+    def _chats_by_user_id_query(num_of_chats: int, user_id: str, before: Optional[tuple[float, int]]) -> Select:
+        # the user's most recent chats with their last message and unread count,
+        # keyset paginated by (last_message_at, id)
+        last_message = aliased(Message)
+        query = (
+            select(
+                Chat.id,
+                Chat.name,
+                Chat.last_message_at,
+                last_message.id.label('message_id'),
+                last_message.sender_id,
+                last_message.text,
+                last_message.created_at,
+                ChatMember.last_read_message_id,
+                (Chat.message_seq - ChatMember.read_seq).label('unread_count'),
+            )
+            .join(ChatMember, ChatMember.chat_id == Chat.id)
+            .outerjoin(last_message, last_message.id == Chat.last_message_id)
+            .where(ChatMember.user_id == user_id)
         )
-        await self.session.execute(
-            delete(Message).where(Message.chat_id == chat_id)
+        if before is not None:
+            query = query.where(tuple_(Chat.last_message_at, Chat.id) < before)
+
+        return query.order_by(Chat.last_message_at.desc(), Chat.id.desc()).limit(num_of_chats)
+
+    async def get_chats_member_ids(self, chat_ids: Sequence[int]) -> dict[int, frozenset[str]]:
+        members = {chat_id: self.members_cache.get(chat_id) for chat_id in chat_ids}
+        missing = [chat_id for chat_id, member_ids in members.items() if member_ids is None]
+        if missing:
+            rows = (await self.session.execute(
+                select(ChatMember.chat_id, ChatMember.user_id).filter(ChatMember.chat_id.in_(missing))
+            )).tuples().all()
+            loaded = {chat_id: set() for chat_id in missing}
+            for chat_id, member_id in rows:
+                loaded[chat_id].add(member_id)
+            for chat_id, member_ids in loaded.items():
+                self.members_cache.set(chat_id, member_ids)
+                members[chat_id] = frozenset(member_ids)
+
+        return members
+
+    async def get_chat_messages(
+            self,
+            chat_id: int,
+            num_of_messages: int = 100,
+            before: Optional[tuple[float, int]] = None,
+            after: Optional[tuple[float, int]] = None,
+    ) -> Sequence[Message]:
+        # keyset pagination over (created_at, id), the newest page by default.
+        # Messages are returned in chronological order. Archived messages are older
+        # than every message left in the table, so they start a page after a cursor
+        # and end it before one
+        query = select(Message).filter(Message.chat_id == chat_id)
+        if after is not None:
+            archived = await self.get_archived_messages(chat_id, num_of_messages, after=after)
+            if len(archived) == num_of_messages:
+                return archived
+            query = (
+                query.filter(tuple_(Message.created_at, Message.id) > after)
+                .order_by(Message.created_at.asc(), Message.id.asc())
+            )
+            return archived + list((await self.session.scalars(query.limit(num_of_messages - len(archived)))).all())
+
+        if before is not None:
+            query = query.filter(tuple_(Message.created_at, Message.id) < before)
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+
+        messages = list((await self.session.scalars(query.limit(num_of_messages))).all())
+        if len(messages) < num_of_messages:
+            oldest = (messages[-1].created_at, messages[-1].id) if messages else before
+            messages += await self.get_archived_messages(chat_id, num_of_messages - len(messages), before=oldest)
+        return messages[::-1]
+
+    async def get_archived_messages(
+            self,
+            chat_id: int,
+            num_of_messages: int,
+            before: Optional[tuple[float, int]] = None,
+            after: Optional[tuple[float, int]] = None,
+    ) -> list[Message]:
+        # messages of the chat's segment files, oldest first after a cursor, newest first otherwise
+        if self.archive_store is None:
+            return []
+
+        query = select(ArchivedSegment.path).filter(ArchivedSegment.chat_id == chat_id)
+        if after is not None:
+            query = query.filter(ArchivedSegment.last_created_at >= after[0]).order_by(ArchivedSegment.first_id.asc())
+        else:
+            if before is not None:
+                query = query.filter(ArchivedSegment.first_created_at <= before[0])
+            query = query.order_by(ArchivedSegment.first_id.desc())
+
+        messages = []
+        for path in (await self.session.scalars(query)).all():
+            rows = await self.archive_store.read(path)
+            if after is not None:
+                rows = sorted(
+                    (row for row in rows if (row['created_at'], row['id']) > after),
+                    key=lambda row: (row['created_at'], row['id']),
+                )
+            else:
+                rows = sorted(
+                    (row for row in rows if before is None or (row['created_at'], row['id']) < before),
+                    key=lambda row: (row['created_at'], row['id']),
+                    reverse=True,
+                )
+            messages += [Message(**row) for row in rows]
+            if len(messages) >= num_of_messages:
+                break
+
+        return messages[:num_of_messages]
+
+    async def get_archivable_messages(self, created_before: float, limit: int) -> Sequence:
+        # the oldest messages first. The newest old message, found through the created_at
+        # index, bounds the scan, nothing is scanned when there is nothing to archive.
+        # The last message of a chat stays in the table for the inbox
+        messages = Message.__table__
+        last_id = await self.session.scalar(
+            select(messages.c.id)
+            .where(messages.c.created_at < created_before)
+            .order_by(messages.c.created_at.desc())
+            .limit(1)
         )
-        await self.session.commit()
+        if last_id is None:
+            return []
 
-        await self.session.execute(
-            delete(ChatMember).where(ChatMember.chat_id == chat_id)
+        result = await self.session.execute(
+            select(messages)
+            .join(Chat.__table__, Chat.id == messages.c.chat_id)
+            .where(
+                messages.c.id <= last_id,
+                messages.c.created_at < created_before,
+                Chat.last_message_id != messages.c.id,
+            )
+            .order_by(messages.c.id)
+            .limit(limit)
         )
-        await self.session.commit()
+        return result.mappings().all()
+
+    async def save_archived_segments(self, segments: Sequence[tuple[int, str, list[dict]]]) -> bool:
+        # records the segments and deletes their messages, nothing changes if some of
+        # the messages are already gone
+        message_ids = [row['id'] for _, _, rows in segments for row in rows]
+        try:
+            await self.session.execute(
+                insert(ArchivedSegment),
+                [
+                    {
+                        'chat_id': chat_id,
+                        'path': path,
+                        'first_id': rows[0]['id'],
+                        'last_id': rows[-1]['id'],
+                        'first_created_at': min(row['created_at'] for row in rows),
+                        'last_created_at': max(row['created_at'] for row in rows),
+                        'message_count': len(rows),
+                    }
+                    for chat_id, path, rows in segments
+                ],
+            )
+            result = await self.session.execute(
+                delete(Message.__table__).where(Message.__table__.c.id.in_(message_ids))
+            )
+        except IntegrityError:
+            await self.session.rollback()
+            return False
+
+        if result.rowcount != len(message_ids):
+            await self.session.rollback()
+            return False
 
-        chat = await self.session.scalar(select(Chat).filter_by(id=chat_id))
-        await self.session.delete(chat)
         await self.session.commit()
+        return True
+
+    async def stream_chat_messages(
+            self,
+            chat_id: int,
+            num_of_messages: int,
+            before: Optional[tuple[float, int]] = None,
+            after: Optional[tuple[float, int]] = None,
+    ) -> AsyncResult:
+        # the same page as get_chat_messages as core rows in chronological order.
+        # `position` is the place of a row in the page counting from the cursor
+        messages = Message.__table__
+        page = select(messages).where(messages.c.chat_id == chat_id)
+        if after is not None:
+            order = (messages.c.created_at.asc(), messages.c.id.asc())
+            page = page.where(tuple_(messages.c.created_at, messages.c.id) > after)
+        else:
+            order = (messages.c.created_at.desc(), messages.c.id.desc())
+            if before is not None:
+                page = page.where(tuple_(messages.c.created_at, messages.c.id) < before)
+
+        page = (
+            page.add_columns(func.row_number().over(order_by=order).label('position'))
+            .order_by(*order)
+            .limit(num_of_messages)
+            .subquery()
+        )
+        return await self.session.stream(select(page).order_by(page.c.created_at.asc(), page.c.id.asc()))
+
+    async def search_messages(
+            self,
+            user_id: str,
+            text: str,
+            num_of_messages: int,
+            after: Optional[tuple[float, int]] = None,
+    ) -> Sequence:
+        # messages of the user's chats matching all words of the text with the user's read cursor,
+        # best matches first. Keyset paginated by (score, id), lower scores are better
+        if self.session.get_bind().dialect.name == 'sqlite':
+            words = re.findall(r'\w+', text)
+            chat_ids = (await self.session.scalars(select(ChatMember.chat_id).filter_by(user_id=user_id))).all()
+            if not words or not chat_ids:
+                return []
+            # matches are limited to the user's chats by the fts index itself, chat ids don't affect the rank
+            terms = ' '.join(f'"{word}"' for word in words)
+            chats = ' OR '.join(str(chat_id) for chat_id in chat_ids)
+            match = f'text : ({terms}) AND chat_id : ({chats})'
+            score = func.bm25(literal_column('messages_fts'), 1.0, 0.0)
+            query = (
+                select(Message, ChatMember.last_read_message_id, score.label('score'))
+                .join(messages_fts, messages_fts.c.rowid == Message.id)
+                .where(literal_column('messages_fts').op('MATCH')(match))
+            )
+        else:
+            document = func.to_tsvector(SEARCH_CONFIG, Message.text)
+            tsquery = func.plainto_tsquery(SEARCH_CONFIG, text)
+            score = -func.ts_rank(document, tsquery)
+            query = (
+                select(Message, ChatMember.last_read_message_id, score.label('score'))
+                .where(document.op('@@')(tsquery))
+            )
 
-    async def get_chats_by_user_id(self, num_of_chats: int, user_id: str) -> Sequence:
-        # todo indices?
-        res = await self.session.execute(
-            select(ChatMember.chat_id)
-            .where(ChatMember.user_id == user_id)
+        query = query.join(
+            ChatMember, and_(ChatMember.chat_id == Message.chat_id, ChatMember.user_id == user_id)
         )
-        user_chat_ids = res.scalars().all()
+        if after is not None:
+            query = query.where(tuple_(score, Message.id) > after)
+
+        result = await self.session.execute(query.order_by(score, Message.id).limit(num_of_messages))
+        return result.tuples().all()
 
+    async def get_last_message_id(self) -> int:
+        return await self.session.scalar(select(func.max(Message.id))) or 0
+
+    async def get_user_messages_after(self, user_id: str, after_id: int, up_to_id: int, limit: int) -> Sequence:
+        # messages of all the user's chats in (after_id, up_to_id] with the user's read cursor,
+        # ids grow with time so this is chronological order
         result = await self.session.execute(
-            select(Message.chat_id, Message.created_at)
-            .where(Message.chat_id.in_(user_chat_ids))
-            .order_by(Message.created_at)
-            .distinct()
-            .limit(num_of_chats)
+            select(Message, ChatMember.last_read_message_id)
+            .join(ChatMember, ChatMember.chat_id == Message.chat_id)
+            .where(ChatMember.user_id == user_id, Message.id > after_id, Message.id <= up_to_id)
+            .order_by(Message.id)
+            .limit(limit)
         )
-        recent_chat_ids = result.scalars().all()
+        return result.tuples().all()
 
-        result = await self.session.execute(
-            select(Chat.id, Chat.name, ChatMember.user_id).
-            join(ChatMember, ChatMember.chat_id == Chat.id).
-            where(Chat.id.in_(recent_chat_ids))
+    async def read_all_messages(self, chat_id: int, user_id: str):
+        stmt = (
+            update(ChatMember)
+            .where(
+                (ChatMember.user_id == user_id) & (ChatMember.chat_id == chat_id)
+            )
+            .values(
+                last_read_message_id=func.coalesce(
+                    select(Chat.last_message_id).where(Chat.id == chat_id).scalar_subquery(),
+                    0,
+                ),
+                read_seq=select(Chat.message_seq).where(Chat.id == chat_id).scalar_subquery(),
+            )
         )
-        return result.mappings().all()
 
-    async def get_chat_messages(self, chat_id: int, num_of_messages: int = 100) -> Sequence[Message]:
-        return await self.get_chats_messages([chat_id], num_of_messages)
+        await self.session.execute(stmt)
+        await self.session.commit()
 
-    async def get_chats_messages(self, chat_ids: list[int], num_of_messages: int = 100) -> Sequence[Message]:
-        ranked_messages_subq = (
-            select(
-                Message.id,
-                func.rank().over(
-                    partition_by=Message.chat_id,
-                    order_by=Message.created_at.asc()
-                ).label('rank')
+    async def read_messages(self, read_up_to: Sequence[tuple[int, str, int]]) -> list[tuple[int, str, int]]:
+        # (chat_id, user_id, message_id) in one transaction. Cursors only move forward and
+        # only to messages of the chat, in the table or in an archived segment. The read
+        # sequence is the chat's minus the messages after the cursor. Returns the moved cursors
+        at_cursor = (
+            select(ChatMember.chat_id, ChatMember.user_id, ChatMember.last_read_message_id)
+            .where(tuple_(ChatMember.chat_id, ChatMember.user_id, ChatMember.last_read_message_id).in_(read_up_to))
+        )
+        already_read = set((await self.session.execute(at_cursor)).tuples().all())
+        in_segments = await self._count_later_in_segments(
+            [(chat_id, message_id) for chat_id, _, message_id in read_up_to]
+        )
+        later = (
+            select(func.count())
+            .where(Message.chat_id == bindparam('b_chat_id'), Message.id > bindparam('b_message_id'))
+            .scalar_subquery()
+        )
+        later_archived = (
+            select(func.coalesce(func.sum(ArchivedSegment.message_count), 0))
+            .where(
+                ArchivedSegment.chat_id == bindparam('b_chat_id'),
+                ArchivedSegment.first_id > bindparam('b_message_id'),
+            )
+            .scalar_subquery()
+        )
+        stmt = (
+            update(ChatMember.__table__)
+            .where(
+                ChatMember.chat_id == bindparam('b_chat_id'),
+                ChatMember.user_id == bindparam('b_user_id'),
+                ChatMember.last_read_message_id < bindparam('b_message_id'),
+                select(Message.id)
+                .where(Message.id == bindparam('b_message_id'), Message.chat_id == bindparam('b_chat_id'))
+                .exists() | bindparam('b_archived', type_=Boolean),
+            )
+            .values(
+                last_read_message_id=bindparam('b_message_id'),
+                read_seq=select(Chat.message_seq).where(Chat.id == bindparam('b_chat_id')).scalar_subquery()
+                - later - later_archived - bindparam('b_later_in_segment'),
             )
-            .filter(Message.chat_id.in_(chat_ids))
-            .subquery()
         )
 
-        limited_messages_query = (
-            select(Message)
-            .join(ranked_messages_subq,
-                  ranked_messages_subq.c.id == Message.id)
-            .filter(ranked_messages_subq.c.rank <= num_of_messages)
-            .order_by(Message.chat_id, Message.created_at.asc())
+        await self.session.execute(
+            stmt,
+            [
+                {
+                    'b_chat_id': chat_id,
+                    'b_user_id': user_id,
+                    'b_message_id': message_id,
+                    'b_archived': (chat_id, message_id) in in_segments,
+                    'b_later_in_segment': in_segments.get((chat_id, message_id), 0),
+                }
+                for chat_id, user_id, message_id in read_up_to
+            ],
         )
+        moved = [row for row in (await self.session.execute(at_cursor)).tuples().all() if row not in already_read]
+        await self.session.commit()
+        return moved
+
+    async def _count_later_in_segments(self, messages: Sequence[tuple[int, int]]) -> dict[tuple[int, int], int]:
+        # (chat_id, message_id) of archived messages -> later messages in the same segment
+        if self.archive_store is None or not messages:
+            return {}
+
+        segments = (await self.session.execute(
+            select(ArchivedSegment.chat_id, ArchivedSegment.path, ArchivedSegment.first_id, ArchivedSegment.last_id)
+            .where(or_(*(
+                and_(
+                    ArchivedSegment.chat_id == chat_id,
+                    ArchivedSegment.first_id <= message_id,
+                    ArchivedSegment.last_id >= message_id,
+                )
+                for chat_id, message_id in messages
+            )))
+        )).all()
 
-        result = await self.session.execute(limited_messages_query)
-        return result.scalars().all()
+        later = {}
+        for chat_id, path, first_id, last_id in segments:
+            message_ids = [row['id'] for row in await self.archive_store.read(path)]
+            for message in messages:
+                if message[0] == chat_id and message[1] in message_ids:
+                    later[message] = sum(1 for message_id in message_ids if message_id > message[1])
+        return later
+
+    async def get_unread_counts(self, user_id: str) -> dict[int, int]:
+        # chats of the user with unread messages
+        return dict((await self.session.execute(
+            select(ChatMember.chat_id, Chat.message_seq - ChatMember.read_seq)
+            .join(Chat, Chat.id == ChatMember.chat_id)
+            .filter(ChatMember.user_id == user_id, Chat.message_seq > ChatMember.read_seq)
+        )).tuples().all())
+
+    async def get_members_unread_counts(self, members: Sequence[tuple[int, str]]) -> dict[tuple[int, str], int]:
+        # (chat_id, user_id) -> unread count
+        rows = (await self.session.execute(
+            select(ChatMember.chat_id, ChatMember.user_id, Chat.message_seq - ChatMember.read_seq)
+            .join(Chat, Chat.id == ChatMember.chat_id)
+            .filter(tuple_(ChatMember.chat_id, ChatMember.user_id).in_(members))
+        )).tuples().all()
+        return {(chat_id, user_id): unread_count for chat_id, user_id, unread_count in rows}
+
+    async def reconcile_unread_counts(self, after_chat_id: int, num_of_chats: int) -> Optional[tuple[int, int]]:
+        # recomputes read sequences of members of the next chats after after_chat_id from
+        # messages and read cursors. Members with a cursor before the end of the chat's
+        # archive are left as they are, segments don't tell whose messages they hold.
+        # Returns the last chat id and the number of fixed members, None at the end
+        chat_ids = (await self.session.scalars(
+            select(Chat.id).where(Chat.id > after_chat_id).order_by(Chat.id).limit(num_of_chats)
+        )).all()
+        if not chat_ids:
+            return None
 
-    async def read_all_messages(self, chat_id: int, user_id: str):
-        stmt = (
-            delete(UnreadMessage)
+        read_seq = (
+            select(Chat.message_seq).where(Chat.id == ChatMember.chat_id).scalar_subquery()
+            - select(func.count())
             .where(
-                (UnreadMessage.user_id == user_id) & (UnreadMessage.chat_id == chat_id)
+                Message.chat_id == ChatMember.chat_id,
+                Message.id > ChatMember.last_read_message_id,
+                Message.sender_id != ChatMember.user_id,
             )
+            .scalar_subquery()
+        )
+        archived_up_to = (
+            select(func.coalesce(func.max(ArchivedSegment.last_id), 0))
+            .where(ArchivedSegment.chat_id == ChatMember.chat_id)
+            .scalar_subquery()
+        )
+        result = await self.session.execute(
+            update(ChatMember)
+            .where(
+                ChatMember.chat_id.in_(chat_ids),
+                ChatMember.last_read_message_id >= archived_up_to,
+                ChatMember.read_seq != read_seq,
+            )
+            .values(read_seq=read_seq)
+            .execution_options(synchronize_session=False)
         )
-
-        await self.session.execute(stmt)
         await self.session.commit()
+        return chat_ids[-1], result.rowcount
 
 
 def get_repository(session: AsyncSession = Depends(get_session)) -> Repository:
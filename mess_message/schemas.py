@@ -1,15 +1,119 @@
-from typing import Optional
+from typing import Optional, Literal, Union, Annotated, Any
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Discriminator, Field, Tag, TypeAdapter
 
 
 class NewMessage(BaseModel):
+    type: Literal['message'] = 'message'
     chat_id: int
     sender_id: str
     text: str
+    # idempotency key, a retried message with the same key is saved once
+    client_message_id: Optional[str] = Field(default=None, max_length=64)
+
+
+class ReadMessages(BaseModel):
+    """Everything in the chat up to and including message_id is read."""
+    type: Literal['read']
+    chat_id: int
+    message_id: int
+
+
+class DeliveredMessages(BaseModel):
+    """Everything in the chat up to and including message_id has reached the client."""
+    type: Literal['delivered']
+    chat_id: int
+    message_id: int
+
+
+class Typing(BaseModel):
+    type: Literal['typing']
+    chat_id: int
+
+
+class Pong(BaseModel):
+    """Answer to a server ping, any frame from the client counts as a sign of life."""
+    type: Literal['pong']
+
+
+def _frame_type(frame: Any) -> str:
+    # frames without a type are messages, that's what clients sent before typed frames
+    if isinstance(frame, dict):
+        return frame.get('type', 'message')
+    return getattr(frame, 'type', 'message')
+
+
+ClientFrame = TypeAdapter(Annotated[
+    Union[
+        Annotated[NewMessage, Tag('message')],
+        Annotated[ReadMessages, Tag('read')],
+        Annotated[DeliveredMessages, Tag('delivered')],
+        Annotated[Typing, Tag('typing')],
+        Annotated[Pong, Tag('pong')],
+    ],
+    Discriminator(_frame_type),
+])
+
+
+class ErrorEvent(BaseModel):
+    """Sent instead of handling a client frame, the socket stays open."""
+    type: Literal['error'] = 'error'
+    # 'invalid_frame', 'forbidden' or 'rate_limited'
+    code: str
+    detail: str
+    chat_id: Optional[int] = None
+
+
+class MessageAck(BaseModel):
+    """Sent to the socket a message came from instead of the message itself."""
+    type: Literal['ack'] = 'ack'
+    client_message_id: Optional[str]
+    id: int
+    chat_id: int
+    created_at: float
+
+
+class Ping(BaseModel):
+    type: Literal['ping'] = 'ping'
+
+
+class ReadEvent(BaseModel):
+    type: Literal['read'] = 'read'
+    chat_id: int
+    # user_id -> the last message the user has read
+    read_up_to: dict[str, int]
+
+
+class DeliveredEvent(BaseModel):
+    type: Literal['delivered'] = 'delivered'
+    chat_id: int
+    # user_id -> the last message delivered to the user
+    delivered_up_to: dict[str, int]
+
+
+class ReplayDone(BaseModel):
+    """Sent after the messages missed while offline. If truncated, the client
+    has to resync through the REST api."""
+    type: Literal['replay_done'] = 'replay_done'
+    last_message_id: Optional[int]
+    truncated: bool
+
+
+class TypingEvent(BaseModel):
+    type: Literal['typing'] = 'typing'
+    chat_id: int
+    user_id: str
+
+
+class UnreadEvent(BaseModel):
+    """Sent to the reader's sockets when their unread count of a chat changes by reading."""
+    type: Literal['unread'] = 'unread'
+    chat_id: int
+    unread_count: int
 
 
 class Message(BaseModel):
+    id: int
     chat_id: int
     sender_id: str
     text: str
@@ -28,7 +132,36 @@ class Chat(BaseModel):
     name: Optional[str]
     member_ids: list[str]
     messages: list[Message]
+    # pass as `before` (or `after` when paging forward) to get the next page
+    next_cursor: Optional[str] = None
+    unread_count: Optional[int] = None
 
 
 class SearchChatResults(BaseModel):
     chats: list[Chat]
+    next_cursor: Optional[str] = None
+
+
+class UnreadCounts(BaseModel):
+    # chat_id -> unread count, chats without unread messages are left out
+    chats: dict[int, int]
+    total: int
+
+
+class SearchMessageResults(BaseModel):
+    messages: list[Message]
+    next_cursor: Optional[str] = None
+
+
+def is_read(sender_id: str, message_id: int, user_id: str, last_read_message_id: int) -> bool:
+    # own messages are read, the others up to the user's read cursor
+    return sender_id == user_id or message_id <= last_read_message_id
+
+
+def encode_cursor(created_at: float, message_id: int) -> str:
+    return f'{created_at!r}_{message_id}'
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    created_at, message_id = cursor.split('_')
+    return float(created_at), int(message_id)
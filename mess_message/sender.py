@@ -1,14 +1,40 @@
-from typing import Sequence
+import time
+from typing import Collection, Optional
 
-from mess_message.managers import ConnectionManager
-from mess_message.models.chat import ChatMember
-from mess_message.schemas import Message
+from mess_message import encoding, metrics
+from mess_message.managers import ConnectionManager, Connection
+from mess_message.schemas import Message, MessageAck
 
 
-async def send_message(message: Message, chat_members: Sequence[ChatMember], connection_manager: ConnectionManager):
-    for member in chat_members:
-        if member.user_id != message.sender_id:
-            await connection_manager.send_personal_message(member.user_id, message.model_dump_json())
+async def send_message(
+        message: Message,
+        member_ids: Collection[str],
+        connection_manager: ConnectionManager,
+        origin: Optional[Connection] = None,
+        client_message_id: Optional[str] = None,
+):
+    started = time.perf_counter() if metrics.sample() else None
 
-    message.is_read = True
-    await connection_manager.send_personal_message(message.sender_id, message.model_dump_json())
+    # large groups go to the fan-out pool as they are, so this doesn't depend on the group size
+    await connection_manager.broadcast(member_ids, encoding.encode(message), skip=message.sender_id)
+    # the socket the message came from only gets an ack, the sender's other sockets get the message
+    await connection_manager.broadcast(
+        [message.sender_id],
+        encoding.encode(message.model_copy(update={'is_read': True})),
+        exclude=origin,
+    )
+    if origin is not None:
+        send_ack(origin, message, client_message_id)
+
+    metrics.fanout_size.observe(len(member_ids) - (message.sender_id in member_ids))
+    if started is not None:
+        metrics.fanout_duration.observe(time.perf_counter() - started)
+
+
+def send_ack(connection: Connection, message: Message, client_message_id: Optional[str] = None):
+    connection.send(encoding.encode(MessageAck(
+        client_message_id=client_message_id,
+        id=message.id,
+        chat_id=message.chat_id,
+        created_at=message.created_at,
+    )))
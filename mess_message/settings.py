@@ -9,6 +9,90 @@ from mess_message import constants
 class Settings(BaseSettings):
     async_db_url: str
 
+    # pool settings are ignored for sqlite
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    # asyncpg only
+    db_prepared_statement_cache_size: int = 500
+    sqlite_pragmas: dict[str, str] = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': '5000'}
+
+    # 'local' for a single process, 'broker' to fan out through mess_message.broker
+    delivery_backend: str = 'local'
+    broker_socket_path: str = '/tmp/mess_message_broker.sock'
+
+    # outbound messages buffered per websocket before the overflow policy kicks in,
+    # 'drop_oldest' or 'disconnect'
+    ws_send_queue_size: int = 256
+    ws_send_queue_overflow: str = 'drop_oldest'
+    # the server pings every interval and closes sockets silent for the idle timeout,
+    # a user with too many sockets loses the oldest ones. 0 disables. Only clients that
+    # answer pings with pong frames stay up with an idle timeout, uvicorn's protocol level
+    # pings already drop dead peers
+    ws_ping_interval: float = 30.0
+    ws_idle_timeout: float = 0.0
+    ws_max_connections_per_user: int = 10
+    # 'pydantic' or 'orjson', orjson falls back to pydantic when it's not installed
+    json_encoder: str = 'pydantic'
+    ws_binary_frames: bool = False
+
+    # token buckets for inbound websocket frames: every frame takes a token of its user,
+    # every message also one of its chat. 'broker' keeps the buckets in mess_message.broker
+    # to share them between workers
+    rate_limit_enabled: bool = True
+    rate_limit_backend: str = 'local'
+    rate_limit_max_keys: int = 100_000
+    user_rate_limit: float = 10.0
+    user_rate_limit_burst: int = 30
+    chat_rate_limit: float = 30.0
+    chat_rate_limit_burst: int = 100
+
+    # broadcasts to at least this many users are delivered by fan-out tasks sharded
+    # by user id and the sender doesn't wait for them. 0 disables
+    large_group_threshold: int = 1000
+    fanout_shards: int = 4
+    fanout_chunk_size: int = 500
+
+    membership_cache_size: int = 10_000
+    membership_cache_ttl: float = 60.0
+    # client_message_id of recently sent messages per worker, for deduplication of retries
+    recent_messages_size: int = 100_000
+    # a typing event per chat and user is sent at most once per interval, repeats are dropped
+    typing_event_interval: float = 3.0
+    recent_typing_size: int = 100_000
+
+    # group commit of messages sent from all sockets of a worker
+    message_batching: bool = False
+    message_batch_max_size: int = 100
+    message_batch_max_linger_ms: float = 5.0
+
+    # read receipts from websockets are written and pushed to members once per window
+    read_receipt_window_ms: float = 500.0
+
+    # unread counts are maintained on writes and recomputed from messages every interval
+    unread_reconcile_enabled: bool = True
+    unread_reconcile_interval: float = 3600.0
+    unread_reconcile_batch_size: int = 500
+
+    # messages missed while offline are sent on reconnect, in chunks, up to the max
+    replay_chunk_size: int = 200
+    replay_max_messages: int = 5000
+
+    # messages older than the retention are moved from the messages table to gzipped
+    # segment files in archive_dir, older history pages are read from there.
+    # Archived history is not readable while this is off
+    archive_enabled: bool = False
+    archive_retention_days: float = 90.0
+    archive_interval: float = 60.0
+    archive_batch_size: int = 1000
+    archive_dir: str = 'archive'
+
+    # query counts are always exact, timings are recorded for this share of events
+    metrics_enabled: bool = True
+    metrics_sample_rate: float = 0.1
+
     def __init__(self):
         if os.environ.get('ENVIRONMENT', 'dev') == 'dev':
             Settings.model_config = SettingsConfigDict(env_file=constants.DEV_ENV_FILE)
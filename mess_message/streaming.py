@@ -0,0 +1,127 @@
+"""Incremental json bodies for large chat and inbox responses.
+
+Rows are read from the database with a server side cursor and written as
+they come, with the same shape as schemas.Chat and schemas.SearchChatResults
+but without building ORM objects or pydantic models.
+"""
+from typing import Any, AsyncIterator, Optional
+
+from mess_message import db, schemas
+from mess_message.encoding import dumps
+from mess_message.repository import Repository
+
+INBOX_CHUNK_SIZE = 50
+
+
+async def chat_json(
+        chat_id: int,
+        name: Optional[str],
+        member_ids: list[str],
+        user_id: str,
+        last_read_message_id: int,
+        limit: int,
+        before: Optional[tuple[float, int]] = None,
+        after: Optional[tuple[float, int]] = None,
+) -> AsyncIterator[str]:
+    yield f'{{"id":{chat_id},"name":{dumps(name)},"member_ids":{dumps(member_ids)},"messages":['
+
+    has_more = False
+    edge = None
+    separator = ''
+    async with db.async_session() as session:
+        # one extra message tells if there is a next page
+        async for position, row in _chat_page(Repository(session), chat_id, limit + 1, before, after):
+            if position > limit:
+                has_more = True
+                continue
+            if after is not None or edge is None:
+                edge = row
+
+            yield separator + dumps({
+                'id': row.id,
+                'chat_id': row.chat_id,
+                'sender_id': row.sender_id,
+                'text': row.text,
+                'is_read': schemas.is_read(row.sender_id, row.id, user_id, last_read_message_id),
+                'created_at': row.created_at,
+            })
+            separator = ','
+
+    next_cursor = schemas.encode_cursor(edge.created_at, edge.id) if has_more and edge is not None else None
+    yield f'],"next_cursor":{dumps(next_cursor)},"unread_count":null}}'
+
+
+async def _chat_page(
+        repository: Repository,
+        chat_id: int,
+        num_of_messages: int,
+        before: Optional[tuple[float, int]],
+        after: Optional[tuple[float, int]],
+) -> AsyncIterator[tuple[int, Any]]:
+    # the page in chronological order with positions counted from the cursor,
+    # archived messages are older than every message left in the table
+    if after is not None:
+        archived = await repository.get_archived_messages(chat_id, num_of_messages, after=after)
+        for position, message in enumerate(archived, 1):
+            yield position, message
+        if len(archived) < num_of_messages:
+            result = await repository.stream_chat_messages(chat_id, num_of_messages - len(archived), after=after)
+            async for row in result:
+                yield len(archived) + row.position, row
+        return
+
+    result = await repository.stream_chat_messages(chat_id, num_of_messages, before=before)
+    row = await result.fetchone()
+    # the oldest row comes first and its position is the size of the page
+    found = row.position if row is not None else 0
+    if found < num_of_messages:
+        oldest = (row.created_at, row.id) if row is not None else before
+        archived = await repository.get_archived_messages(chat_id, num_of_messages - found, before=oldest)
+        for i, message in enumerate(reversed(archived)):
+            yield found + len(archived) - i, message
+    while row is not None:
+        yield row.position, row
+        row = await result.fetchone()
+
+
+async def chats_json(num_of_chats: int, user_id: str, before: Optional[tuple[float, int]] = None) -> AsyncIterator[str]:
+    yield '{"chats":['
+
+    count = 0
+    last = None
+    separator = ''
+    async with db.async_session() as session, db.async_session() as members_session:
+        result = await Repository(session).stream_chats_by_user_id(num_of_chats, user_id, before=before)
+        async for rows in result.mappings().partitions(INBOX_CHUNK_SIZE):
+            member_ids = await Repository(members_session).get_chats_member_ids([row['id'] for row in rows])
+            for row in rows:
+                message = None
+                if row['message_id'] is not None:
+                    message = {
+                        'id': row['message_id'],
+                        'chat_id': row['id'],
+                        'sender_id': row['sender_id'],
+                        'text': row['text'],
+                        'is_read': schemas.is_read(
+                            row['sender_id'], row['message_id'], user_id, row['last_read_message_id'],
+                        ),
+                        'created_at': row['created_at'],
+                    }
+
+                yield separator + dumps({
+                    'id': row['id'],
+                    'name': row['name'],
+                    'member_ids': sorted(member_ids[row['id']]),
+                    'messages': [message] if message is not None else [],
+                    'next_cursor': None,
+                    'unread_count': row['unread_count'],
+                })
+                separator = ','
+
+            count += len(rows)
+            last = rows[-1]
+
+    next_cursor = None
+    if count == num_of_chats:
+        next_cursor = schemas.encode_cursor(last['last_message_at'], last['id'])
+    yield f'],"next_cursor":{dumps(next_cursor)}}}'
@@ -0,0 +1,97 @@
+import asyncio
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from mess_message import logger
+from mess_message.models.chat import Message
+from mess_message.repository import Repository
+
+logger_ = logger.get_logger(__name__, stdout=True)
+
+PendingMessage = tuple[tuple[int, str, str], asyncio.Future]
+
+
+class MessageWriter:
+    """Group commit for messages sent from all sockets of a worker.
+
+    Messages are queued and a single flusher task writes them with one multi-row
+    insert every `max_linger` seconds or every `max_batch_size` messages,
+    each sender awaits the result of its own message.
+    """
+
+    def __init__(
+            self,
+            session_factory: async_sessionmaker[AsyncSession],
+            max_batch_size: int = 100,
+            max_linger: float = 0.005,
+    ):
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_linger = max_linger
+        # None stops the flusher
+        self.queue: asyncio.Queue[Optional[PendingMessage]] = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # not cancelled, the flusher may hold a batch taken off the queue
+            self.queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+        # messages queued after the flusher has stopped
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    async def save_message(self, chat_id: int, sender_id: str, text: str) -> Message:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(((chat_id, sender_id, text), future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            pending = await self.queue.get()
+            if pending is None:
+                return
+            batch = [pending]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_linger)
+
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                pending = self.queue.get_nowait()
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[PendingMessage]):
+        try:
+            async with self.session_factory() as session:
+                messages = await Repository(session).save_messages([message for message, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # don't fail the whole batch because of one bad message
+                logger_.error(f'batch insert of {len(batch)} messages failed, retrying one by one: {e}')
+                for pending in batch:
+                    await self._flush([pending])
+                return
+
+            logger_.exception(f'cannot save message: {e}')
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        for (_, future), message in zip(batch, messages):
+            if not future.done():
+                future.set_result(message)